@@ -0,0 +1,13 @@
+"""
+This module compiles the Jinja templates to Python modules, so that the
+web server can import them instead of compiling them when it starts up.
+
+Authored by Haziq Hairil.
+"""
+
+from modules.rendering import Renderer
+
+COMPILED_TEMPLATES_DIR = "server-store/compiled-templates"
+
+Renderer("src/client/templates").compile_templates(COMPILED_TEMPLATES_DIR)
+print(f"Compiled templates to {COMPILED_TEMPLATES_DIR}")
@@ -94,6 +94,8 @@ def main():
     try:
         # Run the web server
         import server
+
+        server.run()
     finally:
         # Terminate the Redis and Meilisearch servers when the web server is killed
         shut_down_redis_quietly()
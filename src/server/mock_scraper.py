@@ -1,10 +1,12 @@
-import requests
+from urllib.request import urlopen
 from modules.database import DatabaseClient
 
 db = DatabaseClient("src/client/static", "server-store")
-img = requests.get(
+
+with urlopen(
     "https://media.nedigital.sg/fairprice/fpol/media/images/product/L/47440_L1_20210827.jpg"
-).content
+) as res:
+    img = res.read()
 
 p_id = db.create_default_product(
     "Apple",
@@ -0,0 +1,87 @@
+"""
+Provides the in-memory caches shared by the server's modules. They're safe
+to use from the worker threads that page models and partials are built on.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Maps keys to values that expire `ttl` seconds after they're set. Once the
+    cache holds `maxsize` entries, the oldest one is evicted to make room.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        # Maps keys to (expiry time, value) pairs, oldest first
+        self._entries: dict = {}
+        # Page models are built on worker threads, so evictions mustn't
+        # race with other threads adding or invalidating entries
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the value of the key, or `default` if it's missing or expired."""
+        entry = self._entries.get(key)
+
+        if entry is None or entry[0] < time.monotonic():
+            return default
+
+        return entry[1]
+
+    def set(self, key, value):
+        """Sets the value of the key, resetting its expiry time."""
+        with self._lock:
+            # Remove the key first so that it's re-inserted as the newest entry
+            self._entries.pop(key, None)
+
+            if len(self._entries) >= self._maxsize:
+                self._entries.pop(next(iter(self._entries)), None)
+
+            self._entries[key] = (time.monotonic() + self._ttl, value)
+
+    def invalidate(self, key):
+        """Removes the key from the cache if it's there."""
+        # Writes invalidate entries on the event loop, which mustn't
+        # change the dict while `set()` is iterating over it
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class LRUCache:
+    """
+    Maps keys to values, keeping the `maxsize` most recently used entries.
+    Once the cache is full, the least recently used entry is evicted to make
+    room. Values can't be `None`, since `get()` returns that for missing keys.
+    """
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        # Maps keys to values, least recently used first
+        self._entries: OrderedDict = OrderedDict()
+        # Entries are read and set from worker threads, so changes
+        # to their order mustn't race with each other
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value of the key, or `None` if it's missing."""
+        with self._lock:
+            value = self._entries.get(key)
+
+            # Mark the entry as the most recently used one
+            if value is not None:
+                self._entries.move_to_end(key)
+
+            return value
+
+    def set(self, key, value):
+        """Sets the value of the key, evicting the least recently used entry if full."""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+
+            if len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
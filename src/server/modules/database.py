@@ -6,12 +6,17 @@ Authored by Haziq Hairil.
 
 import redis
 import argon2
+import gzip
+import orjson
 import string
 import random
+import sys
+import threading
 import time
 from datetime import date
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional
+from .caching import TTLCache
 from .search import SearchClient
 from .models import (
     User,
@@ -29,6 +34,21 @@ from .models import (
     AdminSettingsPage,
 )
 
+# Number of seconds that the owners of authentication tokens are cached for
+AUTH_CACHE_TTL = 300
+# Number of seconds that whether a user has access to a kitchen is cached for
+ACCESS_CACHE_TTL = 30
+# Number of seconds that the products that barcodes belong to are cached for
+BARCODE_CACHE_TTL = 600
+# Maximum number of connections to Redis. Reads run on asyncio's default thread
+# pool (which has at most 32 threads), so this leaves room for the writes made
+# on the event loop as well. Threads wait for a free connection past this.
+REDIS_MAX_CONNECTIONS = 64
+
+
+# Default value for cache lookups that can distinguish a cached `None`
+_MISSING = object()
+
 
 def _gen_random_id(k=6) -> str:
     """Returns a randomly-generated string of k letters and digits."""
@@ -36,6 +56,20 @@ def _gen_random_id(k=6) -> str:
     return "".join(random.choices(sample_chars, k=k))
 
 
+class _OrjsonEncoder:
+    """Encodes RedisJSON values with orjson instead of the `json` module."""
+
+    def encode(self, obj) -> str:
+        return orjson.dumps(obj).decode()
+
+
+class _OrjsonDecoder:
+    """Decodes RedisJSON values with orjson instead of the `json` module."""
+
+    def decode(self, s: str | bytes):
+        return orjson.loads(s)
+
+
 class DatabaseClient:
     """
     Interfaces with the Redis database and, via
@@ -50,9 +84,16 @@ class DatabaseClient:
         self._static_asset_dir = Path(static_asset_dir)
         self._content_dir = Path(content_dir)
 
-        # Start the Redis client
-        self._r = redis.Redis()
-        self._rj = self._r.json()
+        # Start the Redis client. Every request shares its pool of connections,
+        # which is bounded so that a burst of requests can't open a connection each.
+        self._r = redis.Redis(
+            connection_pool=redis.BlockingConnectionPool(
+                max_connections=REDIS_MAX_CONNECTIONS
+            )
+        )
+        # Every read and write of a kitchen goes through RedisJSON, so use orjson
+        # (which is several times faster than the `json` module) to (de)serialise it
+        self._rj = self._r.json(encoder=_OrjsonEncoder(), decoder=_OrjsonDecoder())
 
         # Start the Meilisearch client
         self._search = SearchClient()
@@ -60,55 +101,82 @@ class DatabaseClient:
         # Password hasher to store passwords securely
         self._ph = argon2.PasswordHasher()
 
+        # Almost every request checks who its auth token belongs to and whether
+        # they can access the kitchen, but these rarely change, so they're cached.
+        # Maps auth tokens to their owners' email addresses (or `None` if invalid).
+        self._auth_token_owners = TTLCache(maxsize=10_000, ttl=AUTH_CACHE_TTL)
+        # Maps (email, kitchen ID) pairs to whether the user
+        # has access to the kitchen and whether they're its admin
+        self._kitchen_access = TTLCache(maxsize=50_000, ttl=ACCESS_CACHE_TTL)
+        # Maps barcodes to the IDs of the products they belong to. The barcode
+        # scanner looks up the same barcode many times while it's held in view.
+        self._barcode_products = TTLCache(maxsize=10_000, ttl=BARCODE_CACHE_TTL)
+        # Number of writes this client has made to kitchens (see `get_write_count()`)
+        self._write_count = 0
+
         # Write empty objects to Redis if they don't already exist
         self._rj.set("products", "$", {}, nx=True)
         self._rj.set("kitchens", "$", {}, nx=True)
 
-    #### FILE ASSETS ####
-
-    def get_static_asset(self, filepath: str, use_cache=True) -> Optional[bytes]:
+    def close(self):
         """
-        Returns the contents of the specified file, or `None` if the file
-        doesn't exist (and isn't cached). `filepath` is relative to the
-        static asset directory specified during initialisation. This will
-        read from disk if `use_cache` is `False`.
+        Waits for queued search index updates to finish, then closes
+        the connections to Redis and Meilisearch. The client can't be
+        used after this is called.
         """
-        # Check the cache
-        cache_key = "static:" + filepath
-        cache = self._r.get(cache_key)
+        try:
+            self._search.close()
+        finally:
+            # Disconnect from Redis even if indexing the queued products failed
+            self._r.close()
+            self._r.connection_pool.disconnect()
 
-        # Return the cached data if we can
-        if use_cache and cache is not None:
-            return cache
+    #### FILE ASSETS ####
 
+    def get_static_asset_path(self, filepath: str) -> Optional[Path]:
+        """
+        Returns the path of the specified static asset on disk, or `None` if
+        the file doesn't exist. `filepath` is relative to the static asset
+        directory specified during initialisation.
+        """
         full_path = self._static_asset_dir / filepath
+        return full_path if full_path.is_file() else None
 
-        # Return None if the file doesn't exist
-        if not full_path.exists():
-            return None
+    def compress_static_assets(self):
+        """
+        Writes a gzipped copy of each static asset next to it (as `<name>.gz`),
+        which `web.FileResponse` sends in place of the original to clients that
+        accept gzip. Copies that are already up to date are left alone.
+        """
+        for path in self._static_asset_dir.iterdir():
+            if not path.is_file() or path.suffix == ".gz":
+                continue
 
-        # Read from disk and update the cache
-        contents = full_path.read_bytes()
-        self._r.set(cache_key, contents)
+            gz_path = path.with_name(path.name + ".gz")
 
-        return contents
+            # Only recompress assets that have changed since their copy was written
+            if gz_path.exists() and gz_path.stat().st_mtime >= path.stat().st_mtime:
+                continue
 
-    def get_product_image(self, kitchen_id: str, product_id: str) -> Optional[bytes]:
+            gz_path.write_bytes(gzip.compress(path.read_bytes(), compresslevel=9))
+
+    def get_product_image_path(
+        self, kitchen_id: str, product_id: str
+    ) -> Optional[Path]:
         """
-        Returns the image of the specified product,
-        or `None` if the image doesn't exist.
+        Returns the path of the specified product's image on
+        disk, or `None` if the image doesn't exist.
         """
         path_default = self._content_dir / f"default-images/{product_id}.jpg"
+
+        if path_default.is_file():
+            return path_default
+
         path_custom = self._content_dir / f"kitchen-{kitchen_id}/{product_id}.jpg"
 
-        if path_default.exists():
-            # Return the image if it's in the default images folder
-            return path_default.read_bytes()
-        elif path_custom.exists():
-            # Return the image if it's in the kitchen's image folder
-            return path_custom.read_bytes()
+        if path_custom.is_file():
+            return path_custom
 
-        # The product doesn't exist
         return None
 
     #### DEFAULT PRODUCTS ####
@@ -124,32 +192,62 @@ class DatabaseClient:
         Creates a new default product in the database.
         Returns the generated ID of the product.
         """
-        product_id = _gen_random_id()
-
-        # Write the product data to the database
-        self._rj.set(
-            "products",
-            f"$.{product_id}",
-            {"name": name, "category": category},
-        )
-
-        # TODO: What if the barcode already exists in the database?
-        if barcodes:
-            self._r.hset("barcodes", mapping={str(b): product_id for b in barcodes})
-
-        # Add this product to the search index
-        self._search.index_default_products({product_id: name})
+        product_id = self.create_default_products([(name, category, barcodes)])[0]
 
         # Write the product image to disk if there is one
         if image is not None:
-            image_dir = self._content_dir / "default-images"
-            # Create the default-images directory if it doesn't already exist
-            image_dir.mkdir(exist_ok=True)
-            # Write the image
-            (image_dir / f"{product_id}.jpg").write_bytes(image)
+            self.default_product_image_path(product_id).write_bytes(image)
 
         return product_id
 
+    def create_default_products(
+        self,
+        products: list[tuple[str, str, list[int]]],
+    ) -> list[str]:
+        """
+        Creates new default products in the database, using a single round trip
+        to Redis. `products` contains (name, category, barcodes) tuples. Returns
+        the generated IDs of the products, in the same order as `products`.
+        """
+        product_ids = [_gen_random_id() for _ in products]
+
+        # Queue up all the writes so they're sent to Redis together
+        pipe = self._rj.pipeline(transaction=False)
+
+        for product_id, (name, category, barcodes) in zip(product_ids, products):
+            # Write the product data to the database
+            pipe.set(
+                "products",
+                f"$.{product_id}",
+                {"name": name, "category": category},
+            )
+
+            # TODO: What if the barcode already exists in the database?
+            if barcodes:
+                pipe.hset("barcodes", mapping={str(b): product_id for b in barcodes})
+
+        pipe.execute()
+
+        # Add the products to the search index
+        self._search.index_default_products(
+            (product_id, name)
+            for product_id, (name, _, _) in zip(product_ids, products)
+        )
+
+        return product_ids
+
+    def default_product_image_path(self, product_id: str) -> Path:
+        """
+        Returns the filepath to write the specified default product's image
+        to. This is for writing images that aren't passed to
+        `create_default_product()`, such as ones being streamed in.
+        """
+        image_dir = self._content_dir / "default-images"
+        # Create the default-images directory if it doesn't already exist
+        image_dir.mkdir(exist_ok=True)
+
+        return image_dir / f"{product_id}.jpg"
+
     def drop_default_products(self):
         """
         Drops all default products from the database.
@@ -204,28 +302,59 @@ class DatabaseClient:
 
     def user_has_access_to_kitchen(self, email: str, kitchen_id: str) -> bool:
         """Returns whether the user has access to the specified kitchen."""
-        # Check if the user even exists
-        if not self._r.exists(f"user:{email}"):
-            return False
+        return self._kitchen_membership(email, kitchen_id)[0]
 
-        # Get the IDs of the kitchens that the user isn't an admin of
-        shared_kitchens = self._rj.get(
-            f"user:{email}",
-            "$.sharedKitchens",
-        )[0]
-        # Check if the user is an admin of the kitchen
-        user_owns_kitchen = self.user_owns_kitchen(email, kitchen_id)
+    def user_owns_kitchen(self, email: str, kitchen_id: str) -> bool:
+        """Returns whether the user is the admin of the specified kitchen."""
+        return self._kitchen_membership(email, kitchen_id)[1]
 
-        return user_owns_kitchen or kitchen_id in shared_kitchens
+    def _kitchen_membership(self, email: str, kitchen_id: str) -> tuple[bool, bool]:
+        """
+        Returns whether the user has access to the specified kitchen,
+        and whether they're its admin, as a (has access, is admin) tuple.
+        """
+        membership = self._kitchen_access.get((email, kitchen_id))
+
+        if membership is None:
+            # Get the IDs of the kitchens that the user is an admin
+            # of and that have been shared with them in one request
+            kitchen_lists = self._rj.get(
+                f"user:{email}",
+                "$.ownedKitchens",
+                "$.sharedKitchens",
+            )
 
-    def user_owns_kitchen(self, email: str, kitchen_id: str) -> bool:
-        # Get the IDs of the kitchens that the user is an admin of
-        owned_kitchens = self._rj.get(
-            f"user:{email}",
-            "$.ownedKitchens",
-        )[0]
+            if kitchen_lists is None:
+                # The user doesn't exist
+                membership = (False, False)
+            else:
+                is_admin = kitchen_id in kitchen_lists["$.ownedKitchens"][0]
+                has_access = (
+                    is_admin or kitchen_id in kitchen_lists["$.sharedKitchens"][0]
+                )
+                membership = (has_access, is_admin)
 
-        return kitchen_id in owned_kitchens
+            self._kitchen_access.set((email, kitchen_id), membership)
+
+        return membership
+
+    def resolve_session(
+        self, auth_token: Optional[str], kitchen_id: str
+    ) -> tuple[Optional[str], bool, bool]:
+        """
+        Returns the email address of the owner of the authentication token,
+        whether they have access to the specified kitchen, and whether they're
+        its admin. The email address is `None` if the token is missing or invalid.
+        """
+        if auth_token is None:
+            return None, False, False
+
+        email = self.get_auth_token_owner(auth_token)
+
+        if email is None:
+            return None, False, False
+
+        return email, *self._kitchen_membership(email, kitchen_id)
 
     def gen_session_token(self) -> str:
         """
@@ -241,26 +370,35 @@ class DatabaseClient:
         auth_token = _gen_random_id()
         # Store the auth token in the database
         self._r.hset("auth-tokens", auth_token, email)
+        # Forget if the token was cached as invalid
+        self._auth_token_owners.invalidate(auth_token)
 
         return auth_token
 
     def delete_auth_token(self, auth_token: str):
         """Removes the authentication token from the database."""
         self._r.hdel("auth-tokens", auth_token)
+        self._auth_token_owners.invalidate(auth_token)
 
     def get_auth_token_owner(self, auth_token: str) -> Optional[str]:
         """
         Returns the email address of the user who owns the specified
         authentication token, or `None` if the token is invalid.
         """
+        cached_email = self._auth_token_owners.get(auth_token, _MISSING)
+        if cached_email is not _MISSING:
+            return cached_email
+
         # Email address of the token's owner
         email_bytes = self._r.hget("auth-tokens", auth_token)
 
-        if email_bytes is None:
-            # The session token doesn't exist (it is invalid)
-            return None
+        # The token is invalid if it doesn't exist. Invalid tokens are cached too,
+        # so that stale cookies (like ones from before logging out) don't cause a
+        # database request every time they're sent.
+        email = email_bytes.decode() if email_bytes is not None else None
+        self._auth_token_owners.set(auth_token, email)
 
-        return email_bytes.decode()
+        return email
 
     #### KITCHEN HANDLING ####
 
@@ -284,9 +422,49 @@ class DatabaseClient:
             },
         )
         self._rj.arrappend(f"user:{email}", "$.ownedKitchens", kitchen_id)
+        self._kitchen_access.invalidate((email, kitchen_id))
+        self._count_write()
 
         return kitchen_id
 
+    def _bump_kitchen_version(self, kitchen_id: str):
+        """
+        Increments the kitchen's version number. This must be called
+        whenever the kitchen's data changes, after the data is written.
+        """
+        self._r.hincrby("kitchen-versions", kitchen_id, 1)
+        self._count_write()
+
+    def _count_write(self):
+        """
+        Increments the count returned by `get_write_count()`. Page models are
+        read on worker threads, but writes are only made on the event loop's
+        thread, so the count is never incremented by two threads at once.
+        The server's `build_page_model()` relies on the count going up
+        before a write's handler returns.
+        """
+        assert (
+            threading.current_thread() is threading.main_thread()
+        ), "Kitchens must only be written to on the event loop's thread"
+        self._write_count += 1
+
+    def get_write_count(self) -> int:
+        """
+        Returns the number of writes that this client has made to kitchens
+        (including creating them), which changes whenever the data of any
+        kitchen does. Unlike kitchen versions, this doesn't need a request to
+        Redis, but it only counts the writes made by this process.
+        """
+        return self._write_count
+
+    def get_kitchen_version(self, kitchen_id: str) -> int:
+        """
+        Returns the kitchen's version number, which changes whenever
+        the kitchen's data does. This is `0` for new kitchens.
+        """
+        version = self._r.hget("kitchen-versions", kitchen_id)
+        return int(version) if version is not None else 0
+
     def share_kitchen(self, kitchen_id: str, email: str) -> bool:
         """
         Adds the user as a member of the kitchen. Returns `False` if there
@@ -306,6 +484,8 @@ class DatabaseClient:
 
         # Add the user to the kitchen's list of non-admin members
         self._rj.arrappend("kitchens", f"$.{kitchen_id}.nonAdmins", email)
+        self._kitchen_access.invalidate((email, kitchen_id))
+        self._bump_kitchen_version(kitchen_id)
 
         return True
 
@@ -338,113 +518,122 @@ class DatabaseClient:
             f"$.{kitchen_id}.nonAdmins",
             kitchen_members,
         )
+        self._kitchen_access.invalidate((email, kitchen_id))
+        self._bump_kitchen_version(kitchen_id)
 
     #### PRODUCT LIST MANAGEMENT ####
 
-    def _product(self, kitchen_id: str, product_id: str) -> Product:
+    def _products(
+        self, kitchen_id: str, product_ids: list[str], list_name: str
+    ) -> list[tuple[Product, Any]]:
         """
-        Checks if the specified product is in the kitchen's custom
-        product list. Returns the product from the custom product
-        list if it is, and from the default product list otherwise.
+        Returns the specified products, each paired with its entry in the kitchen's
+        `list_name` list ("inventory" or "grocery"), or `None` if it isn't in the
+        list. Products are taken from the default product list, or from the kitchen's
+        custom product list if they aren't default products. Everything is fetched
+        in a single round trip to Redis, however many products there are.
         """
-        product_name_matches = self._rj.get("products", f"$.{product_id}.name")
+        # Queue up the lookups for every product so they're sent to Redis together
+        pipe = self._rj.pipeline(transaction=False)
 
-        # Check the custom product list if this product isn't a default product
-        if len(product_name_matches) == 0:
-            product_name = self._rj.get(
-                "kitchens",
-                f"$.{kitchen_id}.customProducts.{product_id}",
-            )[0]
+        for p_id in product_ids:
+            pipe.get("products", f"$.{p_id}")
+            pipe.get("kitchens", f"$.{kitchen_id}.customProducts.{p_id}")
+            pipe.get("kitchens", f"$.{kitchen_id}.{list_name}.{p_id}")
+
+        results = pipe.execute()
+        products: list[tuple[Product, Any]] = []
+
+        for i, p_id in enumerate(product_ids):
+            default_matches, custom_matches, entry_matches = results[3 * i : 3 * i + 3]
+
+            # Check the custom product list if this product isn't a default product
+            if default_matches:
+                product = Product(
+                    id=p_id,
+                    name=default_matches[0]["name"],
+                    # Category names are repeated across many products and are used
+                    # as dict keys when grouping products, so they're interned to
+                    # let those lookups compare strings by identity
+                    category=sys.intern(default_matches[0]["category"]),
+                )
+            else:
+                product = Product(
+                    id=p_id,
+                    name=custom_matches[0],
+                    category="Custom product",
+                )
 
-            return Product(
-                id=product_id,
-                name=product_name,
-                category="Custom product",
-            )
+            products.append((product, entry_matches[0] if entry_matches else None))
 
-        product_category = self._rj.get("products", f"$.{product_id}.category")[0]
+        return products
 
-        return Product(
-            id=product_id,
-            name=product_name_matches[0],
-            category=product_category,
-        )
+    def _inv_products(
+        self, kitchen_id: str, product_ids: list[str]
+    ) -> list[InventoryProduct]:
+        """Returns the specified `InventoryProduct`s, in the same order."""
+        inv_products: list[InventoryProduct] = []
 
-    def _inv_product(self, kitchen_id: str, product_id: str) -> InventoryProduct:
-        """Returns the specified `InventoryProduct`."""
-        # Get the raw expiry data from the database
-        expiry_data_matches = self._rj.get(
-            "kitchens",
-            f"$.{kitchen_id}.inventory.{product_id}",
-        )
-        raw_expiry_data: dict[str, int]
-
-        if expiry_data_matches:
-            raw_expiry_data = expiry_data_matches[0]
-        else:
+        for p, raw_expiry_data in self._products(kitchen_id, product_ids, "inventory"):
             # If there is no database entry for this product in the
             # inventory list, we assign raw_expiry_data to an empty dict
-            raw_expiry_data = {}
-
-        # Maps expiry dates to the amount of the product expiring on the date
-        expiries: dict[date, int] = {
-            # Cast the expiry timestamp from a str
-            # (in unix timestamp format) into a date
-            date.fromtimestamp(float(exp)): amt
-            # Iterate through the key-value pairs of the expiry data
-            for exp, amt in raw_expiry_data.items()
-            # Skip non-expirables (indicated with a -1 expiry date)
-            if exp != "-1"
-        }
-
-        # Insert products in the order we want to iterate over them
-        # (in order of their expiry date). This works in Python 3.7+
-        # because dictionaries iterate in insertion order.
-        expiries = {exp: expiries[exp] for exp in sorted(expiries.keys())}
-
-        # Get the amount of non-expirables
-        non_expiries: int = raw_expiry_data.get("-1", 0)
-
-        # Get the product's name and category
-        p = self._product(kitchen_id, product_id)
-
-        # Calculate the total amount of this product in the inventory list
-        amount = sum(
-            # Get the amounts of all instances (all expiry dates) of this product
-            self._rj.get(
-                "kitchens",
-                f"$.{kitchen_id}.inventory.{product_id}.*",
+            if raw_expiry_data is None:
+                raw_expiry_data = {}
+
+            # Maps expiry dates to the amount of the product expiring on the date
+            expiries: dict[date, int] = {
+                # Cast the expiry timestamp from a str
+                # (in unix timestamp format) into a date
+                date.fromtimestamp(float(exp)): amt
+                # Iterate through the key-value pairs of the expiry data
+                for exp, amt in raw_expiry_data.items()
+                # Skip non-expirables (indicated with a -1 expiry date)
+                if exp != "-1"
+            }
+
+            # Insert products in the order we want to iterate over them
+            # (in order of their expiry date). This works in Python 3.7+
+            # because dictionaries iterate in insertion order.
+            expiries = {exp: expiries[exp] for exp in sorted(expiries.keys())}
+
+            inv_products.append(
+                InventoryProduct(
+                    id=p.id,
+                    name=p.name,
+                    category=p.category,
+                    # The total amount of this product in the
+                    # inventory list, across all its expiry dates
+                    amount=sum(raw_expiry_data.values()),
+                    expiries=expiries,
+                    # Get the amount of non-expirables
+                    non_expirables=raw_expiry_data.get("-1", 0),
+                )
             )
-        )
 
-        return InventoryProduct(
-            id=p.id,
-            name=p.name,
-            category=p.category,
-            amount=amount,
-            expiries=expiries,
-            non_expirables=non_expiries,
-        )
+        return inv_products
+
+    def _inv_product(self, kitchen_id: str, product_id: str) -> InventoryProduct:
+        """Returns the specified `InventoryProduct`."""
+        return self._inv_products(kitchen_id, [product_id])[0]
+
+    def _groc_products(
+        self, kitchen_id: str, product_ids: list[str]
+    ) -> list[GroceryProduct]:
+        """Returns the specified `GroceryProduct`s, in the same order."""
+        return [
+            GroceryProduct(
+                id=p.id,
+                name=p.name,
+                category=p.category,
+                # Products that aren't in the grocery list have an amount of 0
+                amount=amount or 0,
+            )
+            for p, amount in self._products(kitchen_id, product_ids, "grocery")
+        ]
 
     def _groc_product(self, kitchen_id: str, product_id: str) -> GroceryProduct:
         """Returns the specified `GroceryProduct`."""
-        amount_matches = self._rj.get(
-            "kitchens",
-            f"$.{kitchen_id}.grocery.{product_id}",
-        )
-        # Get the amount of the product in the grocery list
-        amount: int = amount_matches[0] if amount_matches else 0
-
-        # Get the other product information
-        p = self._product(kitchen_id, product_id)
-
-        # Add the grocery item to its corresponding list
-        return GroceryProduct(
-            id=p.id,
-            name=p.name,
-            category=p.category,
-            amount=amount,
-        )
+        return self._groc_products(kitchen_id, [product_id])[0]
 
     def _set_inv_product_count(
         self,
@@ -491,7 +680,7 @@ class DatabaseClient:
             # Add the product to the corresponding search index
             self._search.index_inventory_products(
                 kitchen_id,
-                {initial_product.id: initial_product.name},
+                [(initial_product.id, initial_product.name)],
             )
 
         # Set the amount
@@ -500,6 +689,7 @@ class DatabaseClient:
             f"$.{kitchen_id}.inventory.{initial_product.id}.{expiry_timestamp}",
             amount,
         )
+        self._bump_kitchen_version(kitchen_id)
 
     def set_groc_product_count(self, kitchen_id: str, product_id: str, amount: int):
         """
@@ -512,6 +702,7 @@ class DatabaseClient:
             self._rj.delete("kitchens", f"$.{kitchen_id}.grocery.{product_id}")
             # Remove the product from the search index too
             self._search.delete_grocery_product(kitchen_id, product_id)
+            self._bump_kitchen_version(kitchen_id)
             return
 
         product = self._groc_product(kitchen_id, product_id)
@@ -521,7 +712,7 @@ class DatabaseClient:
         if product.amount == 0:
             self._search.index_grocery_products(
                 kitchen_id,
-                {product.id: product.name},
+                [(product.id, product.name)],
             )
 
         # Write the data to the database
@@ -530,6 +721,7 @@ class DatabaseClient:
             f"$.{kitchen_id}.grocery.{product.id}",
             amount,
         )
+        self._bump_kitchen_version(kitchen_id)
 
     def buy_product(
         self,
@@ -624,15 +816,23 @@ class DatabaseClient:
         Given a barcode, returns the ID of the product with that
         barcode, or `None` if no product with that barcode exists.
         """
+        product_id = self._barcode_products.get(barcode)
+        if product_id is not None:
+            return product_id
+
         # Attempt to get the product ID from the database
-        product_id = self._r.hget("barcodes", str(barcode))
+        product_id_bytes = self._r.hget("barcodes", str(barcode))
 
-        # There is no product with the specified barcode
-        if product_id is None:
+        # There is no product with the specified barcode. This isn't cached,
+        # because the scraper might add a product with the barcode later.
+        if product_id_bytes is None:
             return None
 
         # Decode the bytes into a string
-        return product_id.decode()
+        product_id = product_id_bytes.decode()
+        self._barcode_products.set(barcode, product_id)
+
+        return product_id
 
     #### PAGE MODEL GETTERS ####
 
@@ -641,38 +841,56 @@ class DatabaseClient:
         username = self._rj.get(f"user:{email}", "$.name")[0]
         return User(email=email, username=username)
 
+    def _users(self, emails: list[str]) -> list[User]:
+        """
+        Gets the `User`s with the specified email
+        addresses in a single request, in the same order.
+        """
+        if not emails:
+            return []
+
+        name_matches = self._rj.mget([f"user:{e}" for e in emails], "$.name")
+        return [
+            User(email=email, username=matches[0])
+            for email, matches in zip(emails, name_matches)
+        ]
+
     def _kitchen(self, kitchen_id: str) -> Kitchen:
         """Gets the `Kitchen` with the specified ID."""
         kitchen_name = self._rj.get("kitchens", f"$.{kitchen_id}.name")[0]
         return Kitchen(
             id=kitchen_id,
             name=kitchen_name,
+            version=self.get_kitchen_version(kitchen_id),
         )
 
     def kitchens_page_model(self, email: str) -> KitchenListPage:
         """Returns the data necessary to render the kitchen list page."""
-        # Get the IDs of all the kitchens that the user is in
-
-        owned_kitchen_ids = self._rj.get(f"user:{email}", "$.ownedKitchens")[0]
-        shared_kitchen_ids = self._rj.get(f"user:{email}", "$.sharedKitchens")[0]
-        kitchen_ids: list[str] = owned_kitchen_ids + shared_kitchen_ids
-        kitchens: list[Kitchen] = []
+        # Get the user's name and the IDs of all the kitchens they're in at once
+        user_data = self._rj.get(
+            f"user:{email}",
+            "$.name",
+            "$.ownedKitchens",
+            "$.sharedKitchens",
+        )
+        kitchen_ids: list[str] = (
+            user_data["$.ownedKitchens"][0] + user_data["$.sharedKitchens"][0]
+        )
 
-        # Create a `Kitchen` for every ID in `kitchen_ids`
+        # Get the names of all the kitchens in a single round trip to Redis
+        pipe = self._rj.pipeline(transaction=False)
         for k_id in kitchen_ids:
-            # Get the name of the kitchen
-            kitchen_name = self._rj.get("kitchens", f"$.{k_id}.name")[0]
+            pipe.get("kitchens", f"$.{k_id}.name")
 
-            kitchens.append(
-                Kitchen(
-                    id=k_id,
-                    name=kitchen_name,
-                )
-            )
+        # Create a `Kitchen` for every ID in `kitchen_ids`
+        kitchens = [
+            Kitchen(id=k_id, name=name_matches[0])
+            for k_id, name_matches in zip(kitchen_ids, pipe.execute())
+        ]
 
         return KitchenListPage(
             kitchens=kitchens,
-            user=self._user(email),
+            user=User(email=email, username=user_data["$.name"][0]),
         )
 
     def inventory_page_model(
@@ -685,16 +903,18 @@ class DatabaseClient:
         Returns the data necessary to render the inventory list
         page, with the list being sorted by product category.
         """
+        # Get the kitchen (and its version) before the products, so that
+        # the version can't be newer than the product data it's shown with
+        kitchen = self._kitchen(kitchen_id)
+
         # Get the IDs of all the products on the
         # inventory page that match the search query
         product_ids = self._search.search_inventory_products(kitchen_id, search_query)
         # Maps product category names to products in that category
         products: dict[str, list[InventoryProduct]] = {}
 
-        for p_id in product_ids:
-            # Get the inventory product's data
-            p = self._inv_product(kitchen_id, p_id)
-
+        # Get the data of all the inventory products at once
+        for p in self._inv_products(kitchen_id, product_ids):
             # Create an empty list in `products`
             # if the key doesn't already exist
             if p.category not in products:
@@ -703,23 +923,23 @@ class DatabaseClient:
             # Add the inventory item to its corresponding list
             products[p.category].append(p)
 
-        # Insert product categories in the order we want
-        # them to be iterated in. This works in Python 3.7+
-        # because dictionaries iterate in insertion order.
-        products = {
-            # Within each category, sort the products in alphabetical order
-            cat: sorted(
-                products[cat],
-                key=lambda x: x.name,
+        # Freeze the product categories in the order we want them to be
+        # iterated in. Tuples iterate faster than dicts in the templates.
+        sorted_products = tuple(
+            (
+                cat,
+                # Within each category, sort the products in alphabetical order
+                tuple(sorted(products[cat], key=lambda x: x.name)),
             )
             # Iterate through the product categories in alphabetical order
             for cat in sorted(products.keys())
-        }
+        )
 
         return InventoryPage(
-            products=products,
+            products=sorted_products,
+            product_ids=frozenset(product_ids),
             user=self._user(email),
-            kitchen=self._kitchen(kitchen_id),
+            kitchen=kitchen,
         )
 
     def sorted_inventory_page_model(
@@ -732,6 +952,10 @@ class DatabaseClient:
         Returns the data necessary to render the inventory list
         page, with the list being sorted by expiry date.
         """
+        # Get the kitchen (and its version) before the products, so that
+        # the version can't be newer than the product data it's shown with
+        kitchen = self._kitchen(kitchen_id)
+
         # Get the IDs of all the products on the
         # inventory page that match the search query
         product_ids = self._search.search_inventory_products(kitchen_id, search_query)
@@ -740,10 +964,8 @@ class DatabaseClient:
         expirables: list[InventoryProduct] = []
         non_expirables: list[InventoryProduct] = []
 
-        for p_id in product_ids:
-            # Get the inventory product data
-            p = self._inv_product(kitchen_id, p_id)
-
+        # Get the data of all the inventory products at once
+        for p in self._inv_products(kitchen_id, product_ids):
             # Add the product to its corresponding list
             if p.expiries:
                 expirables.append(p)
@@ -758,8 +980,9 @@ class DatabaseClient:
         return SortedInventoryPage(
             # Display the expiring products before those that don't expire
             products=expirables + non_expirables,
+            product_ids=frozenset(product_ids),
             user=self._user(email),
-            kitchen=self._kitchen(kitchen_id),
+            kitchen=kitchen,
         )
 
     def inventory_product_page_model(
@@ -782,6 +1005,9 @@ class DatabaseClient:
         search_query="",
     ) -> GroceryPage:
         """Returns the data required to render the grocery list page."""
+        # Get the kitchen (and its version) before the products, so that
+        # the version can't be newer than the product data it's shown with
+        kitchen = self._kitchen(kitchen_id)
 
         # Maps category names to lists of grocery items
         grocery_products: dict[str, list[GroceryProduct]] = {}
@@ -795,10 +1021,8 @@ class DatabaseClient:
             product_ids.extend(set(default_products) - set(product_ids))
 
         # Loop through the grocery list products to fill up `grocery_products`
-        for p_id in product_ids:
-            # Get the grocery product's data
-            product = self._groc_product(kitchen_id, p_id)
-
+        # (getting the data of all the grocery products at once)
+        for product in self._groc_products(kitchen_id, product_ids):
             # Overwrite the product category if the product isn't in the grocery list
             if product.amount == 0:
                 product.category = "Unowned products"
@@ -820,22 +1044,22 @@ class DatabaseClient:
         if "Unowned products" in grocery_products:
             sorted_product_categories.append("Unowned products")
 
-        # Insert product categories in the order we want
-        # them to be iterated in. This works in Python 3.7+
-        # because dictionaries iterate in insertion order.
-        grocery_products = {
-            # Within the category, sort the products alphabetically
-            cat: sorted(
-                grocery_products[cat],
-                key=lambda p: p.name,
+        # Freeze the product categories in the order we want them to be
+        # iterated in. Tuples iterate faster than dicts in the templates.
+        sorted_grocery_products = tuple(
+            (
+                cat,
+                # Within the category, sort the products alphabetically
+                tuple(sorted(grocery_products[cat], key=lambda p: p.name)),
             )
             for cat in sorted_product_categories
-        }
+        )
 
         return GroceryPage(
-            products=grocery_products,
+            products=sorted_grocery_products,
+            product_ids=frozenset(product_ids),
             user=self._user(email),
-            kitchen=self._kitchen(kitchen_id),
+            kitchen=kitchen,
         )
 
     def grocery_product_page_model(
@@ -860,6 +1084,10 @@ class DatabaseClient:
         Returns the data required to render
         the settings page for kitchen admins.
         """
+        # Get the kitchen (and its version) before the members, so that
+        # the version can't be newer than the member list it's shown with
+        kitchen = self._kitchen(kitchen_id)
+
         # Get the emails of all the non-admin members of the kitchen
         member_emails: list[str] = self._rj.get(
             f"kitchens",
@@ -868,8 +1096,8 @@ class DatabaseClient:
 
         return AdminSettingsPage(
             user=self._user(email),
-            kitchen=self._kitchen(kitchen_id),
-            members=[self._user(e) for e in member_emails],
+            kitchen=kitchen,
+            members=self._users(member_emails),
         )
 
     def generic_kitchen_page_model(
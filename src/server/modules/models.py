@@ -9,32 +9,40 @@ from datetime import date
 
 #### ENTITY MODELS ####
 
+# Entity models are instantiated once per product on every list page,
+# so they use __slots__ to make construction and attribute access cheaper.
 
-@dataclass
+
+@dataclass(slots=True)
 class Kitchen:
     name: str
     id: str
+    # Incremented whenever the kitchen's data changes. Only
+    # kitchen pages need this, so it can be left out elsewhere.
+    version: int = 0
 
 
-@dataclass
+@dataclass(slots=True)
 class User:
     email: str
     username: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Product:
     name: str
+    # Interned with sys.intern() by DatabaseClient, because page
+    # models group products into dicts keyed by their category
     category: str
     id: str
 
 
-@dataclass
+@dataclass(slots=True)
 class GroceryProduct(Product):
     amount: int
 
 
-@dataclass
+@dataclass(slots=True)
 class InventoryProduct(GroceryProduct):
     expiries: dict[date, int]
     non_expirables: int
@@ -42,8 +50,13 @@ class InventoryProduct(GroceryProduct):
 
 #### PAGE MODELS ####
 
+# Page models are never modified once they've been built, so they're frozen.
+# They also compare and hash by identity (eq=False) rather than by value,
+# because hashing by value would walk every product on the page. Caches
+# should be keyed on the kitchen's `version` instead of the page model.
+
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class KitchenListPage:
     """Page model for `/kitchens`."""
 
@@ -51,7 +64,7 @@ class KitchenListPage:
     kitchens: list[Kitchen]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class GenericKitchenPage:
     """
     Serves as a base class for all the page models
@@ -62,7 +75,7 @@ class GenericKitchenPage:
     kitchen: Kitchen
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class SortedInventoryPage(GenericKitchenPage):
     """
     Page model for `/kitchens/{kitchen_id}/inventory`,
@@ -70,40 +83,53 @@ class SortedInventoryPage(GenericKitchenPage):
     """
 
     products: list[InventoryProduct]
+    # IDs of the products on the page, which caches of the rendered
+    # list are keyed on along with the kitchen's `version`
+    product_ids: frozenset[str]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class InventoryPage(GenericKitchenPage):
     """
     Page model for `/kitchens/{kitchen_id}/inventory`,
     with the inventory list sorted by product category.
     """
 
-    products: dict[str, list[InventoryProduct]]
+    # Pairs of category names and the products in that category,
+    # in the order that they should be displayed
+    products: tuple[tuple[str, tuple[InventoryProduct, ...]], ...]
+    # IDs of the products on the page, which caches of the rendered
+    # list are keyed on along with the kitchen's `version`
+    product_ids: frozenset[str]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class GroceryPage(GenericKitchenPage):
     """Page model for `/kitchens/{kitchen_id}/grocery`."""
 
-    products: dict[str, list[GroceryProduct]]
+    # Pairs of category names and the products in that category,
+    # in the order that they should be displayed
+    products: tuple[tuple[str, tuple[GroceryProduct, ...]], ...]
+    # IDs of the products on the page, which caches of the rendered
+    # list are keyed on along with the kitchen's `version`
+    product_ids: frozenset[str]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class GroceryProductPage(GenericKitchenPage):
     """Page model for the page on `/kitchens/{kitchen_id}/grocery/{product_id}`."""
 
     product: GroceryProduct
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class InventoryProductPage(GenericKitchenPage):
     """Page model for the page on `/kitchens/{kitchen_id}/inventory/{product_id}`."""
 
     product: InventoryProduct
 
 
-@dataclass
+@dataclass(slots=True, frozen=True, eq=False)
 class AdminSettingsPage(GenericKitchenPage):
     """
     Page model for the page on `/kitchens/{kitchen_id}/settings`.
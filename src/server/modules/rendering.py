@@ -5,7 +5,13 @@ Authored by Haziq Hairil.
 """
 
 import jinja2
-from typing import Optional
+import markupsafe
+import warnings
+from jinja2 import nodes
+from jinja2.ext import Extension
+from pathlib import Path
+from typing import Iterator, Optional
+from .caching import LRUCache
 from .models import (
     GenericKitchenPage,
     KitchenListPage,
@@ -17,39 +23,316 @@ from .models import (
     AdminSettingsPage,
 )
 
+try:
+    # MarkupSafe escapes every variable that the templates output. Its C
+    # implementation also passes ints (like product amounts) straight
+    # through without scanning them for characters to escape.
+    import markupsafe._speedups
+except ImportError:
+    warnings.warn(
+        "MarkupSafe's C speedups aren't installed, so rendering will be slower"
+    )
+
+# Values of the `page_type` template variable, which the kitchen
+# layout uses to decide which navigation tab to highlight
+PAGE_TYPE_INVENTORY = "inventory"
+PAGE_TYPE_GROCERY = "grocery"
+PAGE_TYPE_SETTINGS = "settings"
+
+# Stands in for the session token when rendering documents that are reused for
+# every session. It only contains characters that HTML escaping leaves alone.
+SESSION_TOKEN_PLACEHOLDER = "SESSIONTOKENPLACEHOLDER"
+
+# Maximum number of generic kitchen page partials kept in memory
+GENERIC_PARTIAL_CACHE_SIZE = 256
+# Maximum number of blocks rendered by `{% cache %}` tags kept in memory
+FRAGMENT_CACHE_SIZE = 256
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Adds a `{% cache key, ... %}...{% endcache %}` tag to Jinja, which
+    renders the enclosed block once per unique set of keys and reuses the
+    rendered HTML afterwards. The keys must change whenever the data
+    displayed in the block does. Rendered blocks are kept in an in-memory
+    LRU cache of `FRAGMENT_CACHE_SIZE` entries.
+    """
+
+    tags = {"cache"}
+
+    def __init__(self, environment: jinja2.Environment):
+        super().__init__(environment)
+        # Maps (template location, ...keys) to the HTML rendered for the block
+        self._fragment_cache = LRUCache(FRAGMENT_CACHE_SIZE)
+
+    def parse(self, parser):
+        # The first token is the `cache` tag name
+        lineno = next(parser.stream).lineno
+
+        # Prefix the keys with the tag's location, so that different
+        # blocks rendered with the same keys don't share a cache entry
+        keys: list[nodes.Expr] = [nodes.Const(f"{parser.name}:{lineno}")]
+        keys.append(parser.parse_expression())
+
+        while parser.stream.skip_if("comma"):
+            keys.append(parser.parse_expression())
+
+        # Everything up to `{% endcache %}` is the block to cache
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+
+        return nodes.CallBlock(
+            self.call_method("_cached_render", [nodes.Tuple(keys, "load")]),
+            [],
+            [],
+            body,
+        ).set_lineno(lineno)
+
+    def _cached_render(self, key: tuple, caller) -> str:
+        """Returns the cached HTML for `key`, rendering it with `caller()` on a miss."""
+        html = self._fragment_cache.get(key)
+
+        if html is None:
+            html = caller()
+            self._fragment_cache.set(key, html)
+
+        return html
+
+
+def _compiled_templates_are_fresh(templates_dir: str, compiled_dir: str) -> bool:
+    """
+    Returns whether `compiled_dir` contains templates compiled with
+    `Renderer.compile_templates()` which are newer than every template
+    in `templates_dir`.
+    """
+    compiled_files = list(Path(compiled_dir).glob("*.py"))
+
+    if not compiled_files:
+        return False
+
+    # The oldest compiled template must be newer than the newest template
+    oldest_compiled = min(f.stat().st_mtime for f in compiled_files)
+    newest_template = max(
+        f.stat().st_mtime for f in Path(templates_dir).rglob("*") if f.is_file()
+    )
+
+    return oldest_compiled >= newest_template
+
 
 class Renderer:
     """Renders Jinja templates from page models."""
 
-    def __init__(self, templates_dir: str):
+    # Error messages shown when logging in or signing up fails
+    LOGIN_FAILED_PARTIAL = "Incorrect password or email address."
+    SIGNUP_FAILED_PARTIAL = "An account with this email address already exists."
+
+    def __init__(
+        self,
+        templates_dir: str,
+        bytecode_cache_dir: Optional[str] = None,
+        compiled_templates_dir: Optional[str] = None,
+    ):
         """
-        `templates_dir` is the file path to the directory
-        that contains the Jinja HTML templates.
+        - `templates_dir` - The filepath of the directory containing the HTML templates.
+        - `bytecode_cache_dir` - The filepath of the directory to cache compiled
+        templates in, so they aren't compiled again when the server restarts.
+        - `compiled_templates_dir` - The filepath of the directory that the templates
+        were compiled to with `compile_templates()`. The compiled templates are
+        imported instead of loading `templates_dir`, unless they're out of date.
         """
-        # Initialise the Jijna environment
+        loader: jinja2.BaseLoader = jinja2.FileSystemLoader(templates_dir)
+        bytecode_cache = None
+
+        if compiled_templates_dir is not None and _compiled_templates_are_fresh(
+            templates_dir, compiled_templates_dir
+        ):
+            # Import the compiled templates as Python modules, which
+            # skips lexing, parsing and compiling the templates entirely
+            loader = jinja2.ModuleLoader(compiled_templates_dir)
+
+        if bytecode_cache_dir is not None:
+            # Create the cache directory if it doesn't already exist
+            Path(bytecode_cache_dir).mkdir(parents=True, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+
+        # Initialise the Jijna environment. Templates don't change while the
+        # server is running, so Jinja doesn't need to check them for changes.
+        # The `{% extends %}` and `{% include %}` tags still look templates up
+        # by name while rendering, so keep every template in a plain dict
+        # (cache_size=-1) rather than Jinja's default LRU cache.
         self._env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(templates_dir),
+            loader=loader,
             autoescape=jinja2.select_autoescape(),
+            auto_reload=False,
+            cache_size=-1,
+            bytecode_cache=bytecode_cache,
+            extensions=[FragmentCacheExtension],
         )
 
-    def _render(self, filepath: str, session_token="", full_doc=False, **kwargs) -> str:
+        # Load every template up front, so that rendering
+        # a page doesn't have to go through the template loader
+        get = self._env.get_template
+        # The templates that wrap the page body: just the body HTML (for HTMX
+        # requests) or the full HTML document, indexed by the `full_doc` bool
+        self._wrappers = (get("_wrapper_partial.html"), get("_wrapper_full.html"))
+
+        self._tpl_login = get("auth/login.html")
+        self._tpl_signup = get("auth/signup.html")
+        self._tpl_kitchens = get("kitchens.html")
+        self._tpl_inventory = get("kitchen/inventory/index.html")
+        self._tpl_inventory_list = get("kitchen/inventory/list.partial.html")
+        self._tpl_sorted_inventory = get("kitchen/inventory/index_sorted.html")
+        self._tpl_sorted_inventory_list = get(
+            "kitchen/inventory/sorted_list.partial.html"
+        )
+        self._tpl_inventory_product = get("kitchen/inventory/product.html")
+        self._tpl_inventory_product_partial = get(
+            "kitchen/inventory/product.partial.html"
+        )
+        self._tpl_move_to_grocery = get(
+            "kitchen/inventory/move_to_grocery.partial.html"
+        )
+        self._tpl_grocery = get("kitchen/grocery/index.html")
+        self._tpl_grocery_list = get("kitchen/grocery/list.partial.html")
+        self._tpl_grocery_product = get("kitchen/grocery/product.html")
+        self._tpl_grocery_amount = get("kitchen/grocery/amount.partial.html")
+        self._tpl_barcode_scanner = get("kitchen/grocery/scan.html")
+        self._tpl_barcode_found = get("kitchen/grocery/barcode_found.partial.html")
+        self._tpl_admin_settings = get("kitchen/settings/admin.html")
+        self._tpl_members_list = get("kitchen/settings/admin.partial.html")
+        self._tpl_nonadmin_settings = get("kitchen/settings/nonadmin.html")
+
+        # The body HTML of the login and signup pages doesn't
+        # depend on the request, so it only needs to be rendered once
+        self._login_partial = self._render(self._tpl_login)
+        self._signup_partial = self._render(self._tpl_signup)
+        # Their full HTML documents only differ by the session token, so
+        # they're rendered once around a placeholder and split into the
+        # pieces that go between each occurrence of the session token
+        self._login_doc_pieces = self._render(
+            self._tpl_login, SESSION_TOKEN_PLACEHOLDER, True
+        ).split(SESSION_TOKEN_PLACEHOLDER)
+        self._signup_doc_pieces = self._render(
+            self._tpl_signup, SESSION_TOKEN_PLACEHOLDER, True
+        ).split(SESSION_TOKEN_PLACEHOLDER)
+
+        # LRU cache mapping (template, kitchen ID, kitchen name) to the body HTML
+        # of the kitchen pages that only display the kitchen's name and ID. It's
+        # bounded, since every kitchen (and every rename) adds entries to it.
+        self._generic_partial_cache = LRUCache(GENERIC_PARTIAL_CACHE_SIZE)
+
+    def compile_templates(self, target_dir: str):
+        """
+        Compiles all the templates to Python modules in `target_dir`,
+        which can be passed to `Renderer` as `compiled_templates_dir`.
+        """
+        self._env.compile_templates(target_dir, zip=None)
+
+    def _render(
+        self,
+        template: jinja2.Template,
+        session_token="",
+        full_doc=False,
+    ) -> str:
         """
-        Returns the rendered Jinja template from the specified filepath.
-        Returns a HTML partial of the page body if `full_doc=False`, and
-        the full HTML document otherwise. Passes additional keyword arguments
-        as Jinja variables.
+        Returns the rendered Jinja template, for templates that don't
+        take any page data. Returns a HTML partial of the page body if
+        `full_doc=False`, and the full HTML document otherwise.
 
         If `full_doc=True`, `session_token` must be specified (because
         the session token is included in the full HTML document).
         """
-        # Use either the full HTML wrapper or the partial one, depending on full_doc
-        wrapper = self._env.get_template(
-            "_wrapper_full.html" if full_doc else "_wrapper_partial.html"
+        return template.render(
+            {
+                "wrapper": self._wrappers[full_doc],
+                "session_token": session_token,
+            }
         )
-        return self._env.get_template(filepath).render(
-            wrapper=wrapper,
-            session_token=session_token,
-            **kwargs,
+
+    def _render_kitchen_page(
+        self,
+        template: jinja2.Template,
+        page_data: GenericKitchenPage,
+        page_type: Optional[str] = None,
+        session_token="",
+        full_doc=False,
+    ) -> str:
+        """
+        Specialised version of `_render()` for the pages (and partials) under
+        `kitchens/{kitchen_id}/`, which all take the same Jinja variables.
+        The Jinja context is built as a single dict literal and passed
+        straight to the template, skipping the keyword argument packing.
+        """
+        return template.render(
+            {
+                "wrapper": self._wrappers[full_doc],
+                "session_token": session_token,
+                "data": page_data,
+                "page_type": page_type,
+            }
+        )
+
+    def _render_fragment(
+        self,
+        template: jinja2.Template,
+        page_data: GenericKitchenPage,
+    ) -> str:
+        """
+        Renders a `.partial.html` template, which is a standalone HTML fragment
+        rather than a page. Fragments don't extend the layout, so they're rendered
+        without the wrapper template or any of the layout's Jinja variables.
+        """
+        return template.render({"data": page_data})
+
+    def _render_generic_kitchen_page(
+        self,
+        template: jinja2.Template,
+        page_data: GenericKitchenPage,
+        page_type: str,
+        session_token: str,
+        full_doc: bool,
+    ) -> str:
+        """
+        Version of `_render_kitchen_page()` for pages that don't display anything
+        but the kitchen's name and ID. Their body HTML is the same for every
+        session, so it's only rendered once per kitchen.
+        """
+        # Full HTML documents include the session token, so they can't be shared
+        if full_doc:
+            return self._render_kitchen_page(
+                template, page_data, page_type, session_token, full_doc
+            )
+
+        kitchen = page_data.kitchen
+        key = (template, kitchen.id, kitchen.name)
+        html = self._generic_partial_cache.get(key)
+
+        if html is None:
+            html = self._render_kitchen_page(template, page_data, page_type)
+            self._generic_partial_cache.set(key, html)
+
+        return html
+
+    def _stream_kitchen_page(
+        self,
+        template: jinja2.Template,
+        page_data: GenericKitchenPage,
+        page_type: str,
+        session_token: str,
+        full_doc: bool,
+    ) -> Iterator[str]:
+        """
+        Same as `_render_kitchen_page()`, but yields the rendered HTML in
+        chunks as the template is evaluated instead of returning it as one
+        string. This lets large pages be sent to the client while they're
+        still being rendered.
+        """
+        return template.generate(
+            {
+                "wrapper": self._wrappers[full_doc],
+                "session_token": session_token,
+                "data": page_data,
+                "page_type": page_type,
+            }
         )
 
     #### AUTHENTICATION ####
@@ -59,22 +342,22 @@ class Renderer:
         Returns the HTML for the login page. Gets the full HTML
         document if `full_doc=True`, and the body HTML otherwise.
         """
-        return self._render("auth/login.html", session_token, full_doc)
+        if not full_doc:
+            return self._login_partial
 
-    def login_failed_partial(self) -> str:
-        """Returns the HTML partial for when a login request fails."""
-        return "Incorrect password or email address."
+        # Escape the session token the same way the template would have
+        return str(markupsafe.escape(session_token)).join(self._login_doc_pieces)
 
     def signup_page(self, session_token: str, full_doc: bool) -> str:
         """
         Returns the HTML for the signup page. Gets the full HTML
         document if `full_doc=True`, and the body HTML otherwise.
         """
-        return self._render("auth/signup.html", session_token, full_doc)
+        if not full_doc:
+            return self._signup_partial
 
-    def signup_failed_partial(self) -> str:
-        """Returns the HTML fragment for when a signup request fails."""
-        return "An account with this email address already exists."
+        # Escape the session token the same way the template would have
+        return str(markupsafe.escape(session_token)).join(self._signup_doc_pieces)
 
     #### KITCHENS LIST ####
 
@@ -88,11 +371,12 @@ class Renderer:
         Returns the HTML for the kitchen list page. Gets the full HTML
         document if `full_doc=True`, and the body HTML otherwise.
         """
-        return self._render(
-            "kitchens.html",
-            session_token,
-            full_doc,
-            data=page_data,
+        return self._tpl_kitchens.render(
+            {
+                "wrapper": self._wrappers[full_doc],
+                "session_token": session_token,
+                "data": page_data,
+            }
         )
 
     #### INVENTORY LIST ####
@@ -107,21 +391,35 @@ class Renderer:
         Returns the HTML of the inventory page,
         with the inventory list sorted by category.
         """
-        return self._render(
-            "/kitchen/inventory/index.html",
+        return self._render_kitchen_page(
+            self._tpl_inventory,
+            page_data,
+            PAGE_TYPE_INVENTORY,
+            session_token,
+            full_doc,
+        )
+
+    def inventory_page_stream(
+        self,
+        page_data: InventoryPage,
+        session_token: str,
+        full_doc: bool,
+    ) -> Iterator[str]:
+        """
+        Yields the HTML of the inventory page in chunks,
+        with the inventory list sorted by category.
+        """
+        return self._stream_kitchen_page(
+            self._tpl_inventory,
+            page_data,
+            PAGE_TYPE_INVENTORY,
             session_token,
             full_doc,
-            data=page_data,
-            page_type="inventory",
         )
 
     def inventory_partial(self, page_data: InventoryPage) -> str:
         """Returns the HTML partial of the inventory list, sorted by category."""
-        return self._render(
-            "kitchen/inventory/list.partial.html",
-            data=page_data,
-            page_type="inventory",
-        )
+        return self._render_fragment(self._tpl_inventory_list, page_data)
 
     def sorted_inventory_page(
         self,
@@ -133,21 +431,35 @@ class Renderer:
         Returns the HTML of the inventory page, with
         the inventory list being sorted by expiry date.
         """
-        return self._render(
-            "kitchen/inventory/index_sorted.html",
+        return self._render_kitchen_page(
+            self._tpl_sorted_inventory,
+            page_data,
+            PAGE_TYPE_INVENTORY,
+            session_token,
+            full_doc,
+        )
+
+    def sorted_inventory_page_stream(
+        self,
+        page_data: SortedInventoryPage,
+        session_token: str,
+        full_doc: bool,
+    ) -> Iterator[str]:
+        """
+        Yields the HTML of the inventory page in chunks, with
+        the inventory list being sorted by expiry date.
+        """
+        return self._stream_kitchen_page(
+            self._tpl_sorted_inventory,
+            page_data,
+            PAGE_TYPE_INVENTORY,
             session_token,
             full_doc,
-            data=page_data,
-            page_type="inventory",
         )
 
     def sorted_inventory_partial(self, page_data: SortedInventoryPage) -> str:
         """Returns the HTML partial of the inventory list, sorted by expiry date."""
-        return self._render(
-            "kitchen/inventory/sorted_list.partial.html",
-            data=page_data,
-            page_type="inventory",
-        )
+        return self._render_fragment(self._tpl_sorted_inventory_list, page_data)
 
     def inventory_product_page(
         self,
@@ -156,32 +468,24 @@ class Renderer:
         full_doc: bool,
     ) -> str:
         """Returns the HTML of an inventory product's page."""
-        return self._render(
-            "kitchen/inventory/product.html",
+        return self._render_kitchen_page(
+            self._tpl_inventory_product,
+            page_data,
+            PAGE_TYPE_INVENTORY,
             session_token,
             full_doc,
-            data=page_data,
-            page_type="inventory",
         )
 
     def inventory_product_partial(self, page_data: InventoryProductPage) -> str:
         """Returns the HTML partial of an inventory product's amount selector."""
-        return self._render(
-            "kitchen/inventory/product.partial.html",
-            data=page_data,
-            page_type="inventory",
-        )
+        return self._render_fragment(self._tpl_inventory_product_partial, page_data)
 
     def inventory_product_confirmation_partial(
         self,
         page_data: InventoryProductPage,
     ) -> str:
         """Returns the HTML partial of the "Move to grocery list?" UI."""
-        return self._render(
-            "kitchen/inventory/move_to_grocery.partial.html",
-            data=page_data,
-            page_type="inventory",
-        )
+        return self._render_fragment(self._tpl_move_to_grocery, page_data)
 
     #### GROCERY LIST ####
 
@@ -192,21 +496,32 @@ class Renderer:
         full_doc: bool,
     ) -> str:
         """Returns the HTML of the grocery page."""
-        return self._render(
-            "kitchen/grocery/index.html",
+        return self._render_kitchen_page(
+            self._tpl_grocery,
+            page_data,
+            PAGE_TYPE_GROCERY,
+            session_token,
+            full_doc,
+        )
+
+    def grocery_page_stream(
+        self,
+        page_data: GroceryPage,
+        session_token: str,
+        full_doc: bool,
+    ) -> Iterator[str]:
+        """Yields the HTML of the grocery page in chunks."""
+        return self._stream_kitchen_page(
+            self._tpl_grocery,
+            page_data,
+            PAGE_TYPE_GROCERY,
             session_token,
             full_doc,
-            data=page_data,
-            page_type="grocery",
         )
 
     def grocery_partial(self, page_data: GroceryPage) -> str:
         """Returns the HTML partial of the grocery list."""
-        return self._render(
-            "kitchen/grocery/list.partial.html",
-            data=page_data,
-            page_type="grocery",
-        )
+        return self._render_fragment(self._tpl_grocery_list, page_data)
 
     def grocery_product_page(
         self,
@@ -215,21 +530,17 @@ class Renderer:
         full_doc: bool,
     ) -> str:
         """Returns the HTML of a grocery product's page."""
-        return self._render(
-            "kitchen/grocery/product.html",
+        return self._render_kitchen_page(
+            self._tpl_grocery_product,
+            page_data,
+            PAGE_TYPE_GROCERY,
             session_token,
             full_doc,
-            data=page_data,
-            page_type="grocery",
         )
 
     def grocery_product_amount_partial(self, page_data: GroceryProductPage) -> str:
         """Returns the HTML partial of a grocery product's amount adjuster"""
-        return self._render(
-            "kitchen/grocery/amount.partial.html",
-            data=page_data,
-            page_type="grocery",
-        )
+        return self._render_fragment(self._tpl_grocery_amount, page_data)
 
     def barcode_scanner_page(
         self,
@@ -238,12 +549,12 @@ class Renderer:
         full_doc: bool,
     ) -> str:
         """Returns the HTML of the barcode scanner page."""
-        return self._render(
-            "kitchen/grocery/scan.html",
+        return self._render_generic_kitchen_page(
+            self._tpl_barcode_scanner,
+            page_data,
+            PAGE_TYPE_GROCERY,
             session_token,
             full_doc,
-            data=page_data,
-            page_type="grocery",
         )
 
     def barcode_found_partial(self, page_data: GroceryProductPage) -> str:
@@ -251,10 +562,7 @@ class Renderer:
         Returns the HTML partial that redirects the
         user to the barcode's corresponding product page.
         """
-        return self._render(
-            "kitchen/grocery/barcode_found.partial.html",
-            data=page_data,
-        )
+        return self._render_fragment(self._tpl_barcode_found, page_data)
 
     #### KITCHEN SETTINGS ####
 
@@ -265,12 +573,12 @@ class Renderer:
         full_doc: bool,
     ) -> str:
         """Returns the HTML of the kitchen settings page for kitchen admins."""
-        return self._render(
-            "kitchen/settings/admin.html",
+        return self._render_kitchen_page(
+            self._tpl_admin_settings,
+            page_data,
+            PAGE_TYPE_SETTINGS,
             session_token,
             full_doc,
-            data=page_data,
-            page_type="settings",
         )
 
     def members_list_partial(
@@ -282,10 +590,8 @@ class Renderer:
         Returns the HTML partial of the kitchen members list.
         `failed_share_email` is used to display the sharing error message.
         """
-        return self._render(
-            "kitchen/settings/admin.partial.html",
-            data=page_data,
-            failed_share=failed_share_email,
+        return self._tpl_members_list.render(
+            {"data": page_data, "failed_share": failed_share_email}
         )
 
     def nonadmin_settings_page(
@@ -295,10 +601,10 @@ class Renderer:
         full_doc: bool,
     ) -> str:
         """Returns the HTML of the kitchen settings page for kitchen admins."""
-        return self._render(
-            "kitchen/settings/nonadmin.html",
+        return self._render_generic_kitchen_page(
+            self._tpl_nonadmin_settings,
+            page_data,
+            PAGE_TYPE_SETTINGS,
             session_token,
             full_doc,
-            data=page_data,
-            page_type="settings",
         )
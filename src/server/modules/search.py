@@ -5,32 +5,61 @@ with the Meilisearch full-text search engine.
 Authored by Lohith Tanuku
 """
 
+import logging
 import meilisearch
 import meilisearch.errors
+from concurrent import futures
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
 
 
 class SearchClient:
     """Handles communication with the Meilisearch server."""
 
-    def __init__(self):
+    def __init__(self, default_index_batch_size=5000):
+        """
+        - `default_index_batch_size` - The number of default products to
+        queue up before they're sent to Meilisearch in a single batch.
+        """
         self._client = meilisearch.Client("http://localhost:7700")
-        self._default_index_buffer: dict[str, str] = {}
+        self._default_index_buffer: list[tuple[str, str]] = []
+        self._default_index_batch_size = default_index_batch_size
+
+        # Batches of default products are uploaded on a background thread, so
+        # that queueing products doesn't block on Meilisearch. A single worker
+        # keeps the batches in order.
+        self._flush_executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_flushes: list[Future] = []
+        # First error raised by a batch since the last flush that waited,
+        # which that flush re-raises. Later errors are only logged.
+        self._flush_error: Optional[BaseException] = None
+
+    def close(self):
+        """
+        Indexes the products still queued to be indexed as default products,
+        then stops the background thread once its work is done.
+        """
+        try:
+            if self._default_index_buffer:
+                self.flush_default_index_queue()
+        finally:
+            # Stop the thread even if indexing the queued products failed
+            self._flush_executor.shutdown()
 
     #### PRODUCT INDEXING ####
 
-    def _add_products_to_index(self, index_name: str, product_names: dict[str, str]):
+    def _add_products_to_index(
+        self, index_name: str, product_names: Iterable[tuple[str, str]]
+    ):
         """
         Adds the given products to the specified search index.
-        `product_names` maps product IDs to product names.
+        `product_names` contains (product ID, product name) pairs.
         """
-        documents = []
-
-        for product_id in product_names:
-            doc = {
-                "id": product_id,
-                "name": product_names[product_id],
-            }
-            documents.append(doc)
+        documents = [
+            {"id": product_id, "name": name} for product_id, name in product_names
+        ]
 
         # Meilisearch returns an error if you try adding an empty list of
         # documents to an index, so we avoid adding the list if it's empty
@@ -46,46 +75,85 @@ class SearchClient:
             #     time.sleep(0.001)
             #     task_status = self._client.get_task(task_uid)["status"]
 
-    def index_default_products(self, product_names: dict[str, str]):
+    def index_default_products(self, product_names: Iterable[tuple[str, str]]):
         """
         Indexes the given products as default products.
-        `product_names` maps product IDs to product names.
+        `product_names` contains (product ID, product name) pairs.
         """
-        self._default_index_buffer.update(product_names)
+        self._default_index_buffer.extend(product_names)
 
-        # Flush the queue when it gets to 1000 in length
-        if len(self._default_index_buffer) >= 1000:
-            self.flush_default_index_queue()
+        # Flush the queue in the background once it fills up a batch
+        if len(self._default_index_buffer) >= self._default_index_batch_size:
+            self.flush_default_index_queue(wait=False)
 
-    def flush_default_index_queue(self):
+    def flush_default_index_queue(self, wait=True):
         """
         Indexes all the products queued to be indexed as
         default products, regardless of the queue length.
+        If `wait=True`, this blocks until every batch queued
+        so far (including this one) has been indexed.
         """
-        self._add_products_to_index(
-            "default",
-            self._default_index_buffer,
-        )
-        self._default_index_buffer = {}
+        # Swap out the buffer before handing it off, so that
+        # products can keep being queued while it uploads
+        buffer = self._default_index_buffer
+        self._default_index_buffer = []
+
+        flush = self._flush_executor.submit(self._index_default_batch, buffer)
+
+        # Forget about the batches that have finished (their
+        # errors are kept by `_index_default_batch()` instead)
+        self._pending_flushes = [f for f in self._pending_flushes if not f.done()]
+        self._pending_flushes.append(flush)
+
+        if wait:
+            # Wait for every batch, even if an earlier one failed
+            futures.wait(self._pending_flushes)
+            self._pending_flushes = []
+
+            # Re-raise the first error that occurred while uploading the batches
+            # (every error has already been logged by `_index_default_batch()`)
+            error, self._flush_error = self._flush_error, None
+            if error is not None:
+                raise error
+
+    def _index_default_batch(self, buffer: list[tuple[str, str]]):
+        """
+        Indexes a batch of default products on the background thread. If it
+        fails, the error is logged, so that it isn't lost when nothing waits
+        for the batch, and kept for the next flush that waits to re-raise.
+        """
+        try:
+            self._add_products_to_index("default", buffer)
+        except Exception as e:
+            logger.error("Failed to index a batch of default products", exc_info=e)
+
+            if self._flush_error is None:
+                self._flush_error = e
 
-    def index_inventory_products(self, kitchen_id: str, product_names: dict[str, str]):
+    def index_inventory_products(
+        self, kitchen_id: str, product_names: Iterable[tuple[str, str]]
+    ):
         """
         Indexes the given products as items of the kitchen's inventory.
-        `product_names` maps product IDs to product names.
+        `product_names` contains (product ID, product name) pairs.
         """
         self._add_products_to_index(kitchen_id + "-inventory", product_names)
 
-    def index_grocery_products(self, kitchen_id: str, product_names: dict[str, str]):
+    def index_grocery_products(
+        self, kitchen_id: str, product_names: Iterable[tuple[str, str]]
+    ):
         """
         Indexes the given products as items of the kitchen's grocery list.
-        `product_names` maps product IDs to product names.
+        `product_names` contains (product ID, product name) pairs.
         """
         self._add_products_to_index(kitchen_id + "-grocery", product_names)
 
-    def index_custom_products(self, kitchen_id: str, product_names: dict[str, str]):
+    def index_custom_products(
+        self, kitchen_id: str, product_names: Iterable[tuple[str, str]]
+    ):
         """
         Indexes the given products as custom products of the kitchen.
-        `product_names` maps product IDs to product names.
+        `product_names` contains (product ID, product name) pairs.
         """
         self._add_products_to_index(kitchen_id + "-custom", product_names)
 
@@ -163,10 +231,11 @@ class SearchClient:
         product name. This will create a new custom product if it
         doesn't already exist in the kitchen's custom product index.
         """
-        self.index_custom_products(kitchen_id, {product_id: new_name})
+        product_names = [(product_id, new_name)]
+        self.index_custom_products(kitchen_id, product_names)
 
         if self._product_is_in_index(kitchen_id + "-inventory", product_id):
-            self.index_inventory_products(kitchen_id, {product_id: new_name})
+            self.index_inventory_products(kitchen_id, product_names)
 
         if self._product_is_in_index(kitchen_id + "-grocery", product_id):
-            self.index_grocery_products(kitchen_id, {product_id: new_name})
+            self.index_grocery_products(kitchen_id, product_names)
@@ -4,16 +4,30 @@ Implements real-time sharing.
 Authored by Lohith Tanuku
 """
 import aiohttp
+import asyncio
+import logging
 from aiohttp import web
 from typing import Awaitable, Callable, Optional
 
+# Number of seconds to collect published topics for before sending the updates
+PUBLISH_WINDOW = 0.02
+# Maximum number of messages that can be waiting to be sent to a session
+# before it's considered too slow to keep up and is disconnected
+SEND_QUEUE_SIZE = 256
+
+logger = logging.getLogger(__name__)
+
 
 class WebSocketManager:
     """Handles WebSocket communication via a pub/sub system."""
 
     def __init__(self):
-        # Maps topics to functions that update the corresponding UI
-        self._topic_based_updaters: dict[str, set[Callable[[], Awaitable[None]]]] = {}
+        # Maps topics to the sessions subscribed to them, along with
+        # the functions that render the updated HTML for each session
+        self._topic_subscribers: dict[str, list[tuple[str, Callable[[], str]]]] = {}
+        # Maps (topic, session token) pairs to the session's index in the
+        # topic's list of subscribers, so that it can be removed quickly
+        self._subscriber_indexes: dict[tuple[str, str], int] = {}
         # Maps session tokens to functions that update
         # the UI when a WebSocket message is received
         self._message_based_updaters: dict[str, Callable[[bytes], Awaitable[None]]] = {}
@@ -23,6 +37,18 @@ class WebSocketManager:
         self._unsubscribers: dict[str, Callable[[], None]] = {}
         # Maps session tokens to their corresponding WebSocketResponse objects
         self._connections: dict[str, web.WebSocketResponse] = {}
+        # Maps session tokens to the queues of messages waiting to be sent to them.
+        # Each connection has a single task that sends its queued messages, so
+        # that messages are sent in order without a task being created per send.
+        self._send_queues: dict[str, asyncio.Queue[str]] = {}
+        # Tasks closing the connections of sessions that fell behind,
+        # which are referenced here so they aren't garbage collected
+        self._closing_tasks: set[asyncio.Task] = set()
+
+        # Topics published to since the last batch of updates was sent
+        # (a dict is used as an ordered set), and the task that sends them
+        self._pending_topics: dict[str, None] = {}
+        self._flush_task: Optional[asyncio.Task] = None
 
     async def handle_connection(self, session_token: str, ws: web.WebSocketResponse):
         """
@@ -32,17 +58,68 @@ class WebSocketManager:
         # Save the WebSocket connection to allow other methods to access it
         self._connections[session_token] = ws
 
-        # Asynchronously loop through received messages
-        async for msg in ws:
-            # Call the session's message-based UI updater (if it has one)
-            if session_token in self._message_based_updaters:
-                await self._message_based_updaters[session_token](msg.data)
+        # Start sending the messages queued for this session
+        queue = self._send_queues[session_token] = asyncio.Queue(SEND_QUEUE_SIZE)
+        sender = asyncio.create_task(self._send_queued_messages(ws, queue))
+
+        try:
+            # Asynchronously loop through received messages
+            async for msg in ws:
+                # Call the session's message-based UI updater (if it has one)
+                update_message_ui = self._message_based_updaters.get(session_token)
+                if update_message_ui is not None:
+                    await update_message_ui(msg.data)
+        finally:
+            # Cleanup: remove all the data associated with this session, even if
+            # an updater raised. The send queue may have already been removed
+            # by _queue_message() if the session was disconnected for being slow.
+            unsubscribe = self._unsubscribers.pop(session_token, None)
+            if unsubscribe is not None:
+                unsubscribe()
+
+            self._connections.pop(session_token, None)
+            self._send_queues.pop(session_token, None)
+            sender.cancel()
+
+    async def _send_queued_messages(
+        self, ws: web.WebSocketResponse, queue: asyncio.Queue[str]
+    ):
+        """Sends the messages put in the queue through the WebSocket, in order."""
+        while True:
+            message = await queue.get()
+
+            try:
+                await ws.send_str(message)
+            except ConnectionResetError:
+                # The connection closed while sending,
+                # so there's nobody left to send to
+                return
+            except Exception:
+                # Nothing awaits the sender, so its exception would otherwise be
+                # lost. Closing the socket ends handle_connection(), which cleans
+                # up the session instead of queueing messages that are never sent.
+                logger.exception("Failed to send a WebSocket message")
+                await ws.close()
+                return
+
+    def _queue_message(self, session_token: str, message: str):
+        """Queues the message to be sent to the session, if it's connected."""
+        queue = self._send_queues.get(session_token)
+        if queue is None:
+            return
 
-        # Cleanup: remove all the data associated with this session
-        if session_token in self._unsubscribers:
-            self._unsubscribers.pop(session_token)()
+        if not queue.full():
+            queue.put_nowait(message)
+            return
 
-        self._connections.pop(session_token)
+        # The client isn't keeping up with its updates, so disconnect it instead of
+        # buffering them without limit. This also ends its handle_connection() call.
+        # Removing its queue stops any more messages (and so any more closing
+        # tasks) from being queued for it while it closes.
+        del self._send_queues[session_token]
+        task = asyncio.create_task(self._connections[session_token].close())
+        self._closing_tasks.add(task)
+        task.add_done_callback(self._closing_tasks.discard)
 
     def subscribe(
         self,
@@ -58,45 +135,37 @@ class WebSocketManager:
         `topic_callbacks` maps topics to callbacks that render the updated
         HTML. If an empty string is used as a topic, the corresponding
         callback will be called whenever a WebSocket message is received.
+        Callbacks that compare equal must render the same HTML, because
+        they're only called once per update for all their sessions.
         """
         # Unsubscribe this session from all updates it's already subscribed to
-        if session_token in self._unsubscribers:
-            self._unsubscribers.pop(session_token)()
+        prev_unsubscribe = self._unsubscribers.pop(session_token, None)
+        if prev_unsubscribe is not None:
+            prev_unsubscribe()
 
-        # Maps topics to functions that update the UI for the corresponding topic
-        topic_ui_updaters = {}
+        for topic, render in topic_renderers.items():
+            # Subscribe the session to the topic (creating
+            # the topic if it doesn't already exist)
+            subscribers = self._topic_subscribers.setdefault(topic, [])
+            self._subscriber_indexes[topic, session_token] = len(subscribers)
+            subscribers.append((session_token, render))
 
-        for topic in topic_renderers:
+        if receiving_renderer is not None:
 
-            async def update_topic_ui():
+            async def update_message_ui(msg: bytes, render=receiving_renderer):
                 """Render updated HTML and send it to the client to update their UI."""
-                ws = self._connections[session_token]
-                updated_html = topic_renderers[topic]()
-                await ws.send_str(updated_html)
+                # Rendering can decode images and query the database,
+                # so it's run on a worker thread to keep the loop free
+                self._queue_message(session_token, await asyncio.to_thread(render, msg))
 
-            # Create this topic if it doesn't already exist
-            if topic not in self._topic_based_updaters:
-                self._topic_based_updaters[topic] = set()
-
-            # Subscribe the UI updater to the topic
-            self._topic_based_updaters[topic].add(update_topic_ui)
-            topic_ui_updaters[topic] = update_topic_ui
-
-        async def update_message_ui(msg: bytes):
-            """Render updated HTML and send it to the client to update their UI."""
-            if receiving_renderer:
-                ws = self._connections[session_token]
-                rendered_msg = receiving_renderer(msg)
-                await ws.send_str(rendered_msg)
-
-        # Register the message-based UI updater
-        self._message_based_updaters[session_token] = update_message_ui
+            # Register the message-based UI updater
+            self._message_based_updaters[session_token] = update_message_ui
 
         def unsubscribe():
             """Unsubscribes this session from all its newly subscribed topics."""
-            # Unsubscribe each topic UI updater from their corresponding topic
-            for topic in topic_ui_updaters:
-                self._topic_based_updaters[topic].remove(topic_ui_updaters[topic])
+            # Unsubscribe the session from each of the topics
+            for topic in topic_renderers:
+                self._remove_subscriber(topic, session_token)
 
             # Remove the message UI updater if it exists
             if receiving_renderer is not None:
@@ -105,17 +174,129 @@ class WebSocketManager:
         # Register the unsubscriber
         self._unsubscribers[session_token] = unsubscribe
 
+    def _remove_subscriber(self, topic: str, session_token: str):
+        """
+        Unsubscribes the session from the topic. The session is swapped
+        with the last subscriber in the topic's list before being popped
+        off, so the rest of the list doesn't need to be shifted along.
+        """
+        subscribers = self._topic_subscribers[topic]
+        index = self._subscriber_indexes.pop((topic, session_token))
+        last_subscriber = subscribers.pop()
+
+        # Move the last subscriber into the removed subscriber's place
+        if last_subscriber[0] != session_token:
+            subscribers[index] = last_subscriber
+            self._subscriber_indexes[topic, last_subscriber[0]] = index
+
+        # Forget about the topic once nobody is subscribed to it,
+        # so that publish_update() only ever looks at live topics
+        if not subscribers:
+            del self._topic_subscribers[topic]
+
     async def publish_update(self, topics: list[str]):
         """
         For every user session subscribed to a topic in `topics`,
         updates their UI using the registered rendering callback.
+
+        Topics published within `PUBLISH_WINDOW` seconds of each other are
+        sent together, so a burst of changes to a kitchen only re-renders
+        and sends each session's UI once. This returns without waiting
+        for the updates to be sent.
         """
-        # Call all the UI updaters that are subscribed to the specified topics
+        self._pending_topics.update(dict.fromkeys(topics))
+
+        # Start a new batch if one isn't already being collected
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_pending_topics())
+            self._flush_task.add_done_callback(self._report_failed_flush)
+
+    def _report_failed_flush(self, flush: asyncio.Task):
+        """Logs the exception of a batch of updates that failed to be sent."""
+        # Nothing awaits the flush task, so its exception would otherwise be lost
+        if not flush.cancelled() and flush.exception() is not None:
+            logger.error("Failed to send published updates", exc_info=flush.exception())
+
+    async def _flush_pending_topics(self):
+        """Sends the updates for every pending topic after `PUBLISH_WINDOW`."""
+        await asyncio.sleep(PUBLISH_WINDOW)
+
+        # Take the pending topics, so that topics published while
+        # these updates are being sent go into the next batch
+        topics = list(self._pending_topics)
+        self._pending_topics.clear()
+        self._flush_task = None
+
+        await self._send_updates(topics)
+
+    async def _send_updates(self, topics: list[str]):
+        """Re-renders and sends the UI of every session subscribed to `topics`."""
+        # Collect the sessions to update along with their renderers. A dict is
+        # used as an ordered set, so that a session subscribed to several of
+        # the topics with the same renderer is only sent the update once.
+        updates: dict[tuple[str, Callable[[], str]], None] = {}
+
         for topic in topics:
-            # Ignore this topic if haven't been any
-            # updaters that subscribed to the topic
-            if topic not in self._topic_based_updaters:
+            # Skip topics that nobody has subscribed to
+            subscribers = self._topic_subscribers.get(topic)
+            if subscribers:
+                updates.update(dict.fromkeys(subscribers))
+
+        # Nobody needs updating (which is usually the case when
+        # a kitchen isn't shared), so there's nothing to render
+        if not updates:
+            return
+
+        # Maps session tokens to the renderers of the HTML to send to the session
+        session_renderers: dict[str, list[Callable[[], str]]] = {}
+
+        for session_token, render in updates:
+            # Skip sessions whose WebSocket hasn't connected yet
+            if session_token in self._send_queues:
+                session_renderers.setdefault(session_token, []).append(render)
+
+        # Renderers that compare equal (like those of every session viewing the same
+        # kitchen page) are only called once, so their sessions share a single render.
+        # Rendering fetches the page data from the database (and search engine), so
+        # the distinct renderers are run concurrently on worker threads.
+        distinct_renderers = list(
+            dict.fromkeys(r for rs in session_renderers.values() for r in rs)
+        )
+        results = await asyncio.gather(
+            *(asyncio.to_thread(render) for render in distinct_renderers),
+            return_exceptions=True,
+        )
+
+        # Maps renderers to the HTML they rendered during this update
+        rendered: dict[Callable[[], str], str] = {}
+
+        for render, result in zip(distinct_renderers, results):
+            if isinstance(result, Exception):
+                # Don't let one failed render stop every other session
+                # from being updated, just skip sending this one
+                logger.error("Failed to render a published update", exc_info=result)
+            else:
+                rendered[render] = result
+
+        # Send each session all of its updated HTML in a single WebSocket message.
+        # HTMX swaps in each top-level element of a message by its ID, so the
+        # fragments can simply be concatenated. Messages are keyed by the fragments
+        # they're made of, so sessions that were sent the same HTML (like everyone
+        # viewing the same page) share one message instead of each joining their own.
+        # Shared renders are the same string objects, whose hashes Python caches.
+        messages: dict[tuple[str, ...], str] = {}
+
+        for session_token, renderers in session_renderers.items():
+            # Skip the renderers that failed to render
+            fragments = tuple(rendered[r] for r in renderers if r in rendered)
+            if not fragments:
                 continue
 
-            for update_ui in self._topic_based_updaters[topic]:
-                await update_ui()
+            message = messages.get(fragments)
+
+            if message is None:
+                message = messages[fragments] = "".join(fragments)
+
+            # Each session's sender task sends its message, so that a
+            # slow connection doesn't hold up updating the other sessions
+            self._queue_message(session_token, message)
@@ -6,9 +6,39 @@ Authored by Lohith Tanuku. Co-authored by Haziq Hairil.
 
 import asyncio
 import aiohttp
-import bs4
-import json
+import orjson
+import os
+import re
+import sys
 from modules.database import DatabaseClient
+from pathlib import Path
+
+try:
+    # uvloop is a much faster drop-in replacement for asyncio's event loop
+    import uvloop
+except ImportError:
+    # uvloop isn't available on Windows
+    uvloop = None
+
+# Maximum number of requests to have in flight at once
+MAX_CONCURRENT_REQUESTS = 256
+# Number of pages of a category to scrape at a time
+PAGE_BATCH_SIZE = 128
+# Size (in bytes) of the pieces that product images are written to disk in
+IMAGE_CHUNK_SIZE = 64 * 1024
+# Minimum number of seconds between updates to the printed progress
+PROGRESS_INTERVAL = 0.1
+
+# Where the category slugs and names are saved once they've been scraped, so
+# that re-running the scraper (e.g. after a crash) can skip fetching them.
+# Delete this file to scrape the categories again.
+CATEGORIES_CACHE_PATH = Path("server-store/categories.json")
+
+# Matches the script tag containing the FairPrice site's Next props
+NEXT_DATA_PATTERN = re.compile(
+    rb'<script[^>]*\bid="__NEXT_DATA__"[^>]*>(.*?)</script>',
+    re.DOTALL,
+)
 
 
 class Scraper:
@@ -21,32 +51,49 @@ class Scraper:
 
         self.products_discovered: int = 0
         self.products_scraped: int = 0
+        # The scraper is only ever created and run inside one event loop, so
+        # look it up once instead of every time the progress is printed
+        self._loop = asyncio.get_running_loop()
+        # Event loop time of the last progress update
+        self._last_progress_print: float = 0.0
+
+        # Limits the number of requests in flight, so that scraping every
+        # product's image at once doesn't open thousands of connections
+        self.request_limiter = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
     async def init_product_categories(self):
         """Fills `self.categories`."""
+        # Use the categories saved by a previous run if there are any
+        if CATEGORIES_CACHE_PATH.exists():
+            self.categories = orjson.loads(CATEGORIES_CACHE_PATH.read_bytes())
+            print("Loaded saved categories")
+            return
+
         async with self.session.get("https://www.fairprice.com.sg") as res:
             print("Fetched FairPrice homepage")
 
-            # Parse the response payload as a Beautiful Soup document
-            soup = bs4.BeautifulSoup(await res.read(), features="html.parser")
-
-            # Get the script tag containing the site's Next props
-            next_data_tag = soup.find(id="__NEXT_DATA__")
-            assert isinstance(next_data_tag, bs4.Tag)
-
-            # Get the script's string contents
-            next_data = next_data_tag.string
+            # Get the contents of the script tag containing the site's Next
+            # props. This is the only part of the page we need, so there's
+            # no point parsing the whole document.
+            next_data = NEXT_DATA_PATTERN.search(await res.read())
             assert next_data is not None
 
-            raw_categories = json.loads(next_data)["props"]["categories"][0]
+            raw_categories = orjson.loads(next_data[1])["props"]["categories"][0]
 
             print("Parsed Next data")
 
+            # self.categories is keyed by slug, so sub-categories listed under
+            # several top-level categories are still only scraped once
             for top_cat in raw_categories:
                 for sub_cat in top_cat["menu"]:
-                    slug = sub_cat["url"].split("/")[-1]
+                    # rpartition() only splits off the last path segment
+                    slug = sub_cat["url"].rpartition("/")[2]
                     self.categories[slug] = sub_cat["name"]
 
+        # Save the categories for the next run
+        CATEGORIES_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        CATEGORIES_CACHE_PATH.write_bytes(orjson.dumps(self.categories))
+
     async def scrape(self):
         """Scrapes all the products from the FairPrice API and writes the scraped data to the database."""
         tasks = [self.scrape_category(cat) for cat in self.categories.keys()]
@@ -57,9 +104,13 @@ class Scraper:
 
         total_pages = await self.scrape_page(category, 1)
 
-        # Scrape all the other pages in parallel
-        tasks = [self.scrape_page(category, i) for i in range(2, total_pages + 1)]
-        await asyncio.gather(*tasks)
+        # Scrape all the other pages in parallel, a batch at a time so
+        # that huge categories don't create all their tasks up front
+        for start in range(2, total_pages + 1, PAGE_BATCH_SIZE):
+            end = min(start + PAGE_BATCH_SIZE, total_pages + 1)
+            await asyncio.gather(
+                *(self.scrape_page(category, i) for i in range(start, end))
+            )
 
     async def scrape_page(
         self,
@@ -74,39 +125,68 @@ class Scraper:
         endpoint = self.api_url(category_slug, page)
 
         # Get the data from the API
-        async with self.session.get(endpoint) as res:
-            body = await res.json()
+        async with self.request_limiter:
+            async with self.session.get(endpoint) as res:
+                # orjson decodes JSON several times faster than the json module
+                body = await res.json(loads=orjson.loads)
+
+        # Missing fields are checked for with .get() instead of being
+        # left to raise, so that a malformed page just has no products
+        data = body.get("data") or {}
+        pagination = data.get("pagination") or {}
 
         # Gets current page to show progress
-        curr_page = body["data"]["pagination"]["page"]
+        curr_page = pagination.get("page", 0)
 
         # Get total pages in the category
-        total_pages = body["data"]["pagination"]["total_pages"]
+        total_pages = pagination.get("total_pages", 0)
+
+        products = data.get("product") or []
+
+        self.products_discovered += len(products)
+        self.print_progress()
 
-        # Print current progress
-        self.products_discovered += len(body["data"]["product"])
-        print(
-            f"\rScraped {self.products_scraped} of {self.products_discovered} discovered products",
-            end="",
+        # Add all the products on the page to the database at once
+        product_ids = self.db.create_default_products(
+            [self.extract_product(p, category_slug) for p in products]
         )
 
-        # Gets product information from the response
-        tasks = [
-            self.extract_product(p, category_slug) for p in body["data"]["product"]
-        ]
+        # Download the images of the products that have one
+        await asyncio.gather(
+            *(
+                self.download_image(product_id, p["images"][0])
+                for product_id, p in zip(product_ids, products)
+                if p.get("images")
+            )
+        )
 
-        await asyncio.gather(*tasks)
+        self.products_scraped += len(products)
 
         return total_pages
 
-    async def extract_product(
+    def print_progress(self, force=False):
+        """
+        Prints the number of products scraped so far. Pages finish scraping
+        concurrently, so this is throttled to a few updates a second
+        (unless `force=True`) instead of writing to stdout on every page.
+        """
+        now = self._loop.time()
+
+        if force or now - self._last_progress_print >= PROGRESS_INTERVAL:
+            self._last_progress_print = now
+            sys.stdout.write(
+                f"\rScraped {self.products_scraped} of {self.products_discovered} discovered products"
+            )
+            sys.stdout.flush()
+
+    def extract_product(
         self,
         product: dict,
         category_slug,
-    ):
+    ) -> tuple[str, str, list[int]]:
         """
-        Given a raw product dictionary supplied by the FairPrice API,
-        extracts the necessary information and writes it to the database.
+        Given a raw product dictionary supplied by the FairPrice API, extracts
+        the product's name, category and barcodes to write to the database.
         """
         # Get product name
         name = product["name"]
@@ -115,24 +195,50 @@ class Scraper:
         category = self.categories[category_slug]
 
         # Get product barcode
-        barcodes: list[str] = product["barcodes"] or []
-
-        image = None
+        barcodes: list[str] = product.get("barcodes") or []
 
-        # Get product image
-        if product["images"] is not None:
-            async with self.session.get(product["images"][0]) as res:
-                image = await res.read()
+        return name, category, list(map(int, barcodes))
 
-        # Adds product to database
-        self.db.create_default_product(
-            name,
-            category,
-            [int(b) for b in barcodes],
-            image,
-        )
-
-        self.products_scraped += 1
+    async def download_image(self, product_id: str, url: str):
+        """
+        Downloads a default product's image and writes it to disk. The image is
+        streamed to a temporary file first, which only replaces the product's image
+        once it's complete, so an interrupted run never leaves a truncated image.
+        """
+        image_path = self.db.default_product_image_path(product_id)
+        temp_path = image_path.with_name(image_path.name + ".part")
+
+        async with self.request_limiter:
+            async with self.session.get(url) as res:
+                # Don't save error pages as images
+                if res.status != 200:
+                    return
+
+                # The file is written on other threads, so that
+                # the disk I/O doesn't hold up the other downloads
+                f = await asyncio.to_thread(temp_path.open, "wb")
+
+                try:
+                    # Stream the image to disk as it downloads,
+                    # instead of holding all of it in memory first
+                    async for chunk in res.content.iter_chunked(IMAGE_CHUNK_SIZE):
+                        await asyncio.to_thread(f.write, chunk)
+                except BaseException:
+                    # Don't leave the incomplete image behind
+                    await asyncio.to_thread(self.discard_image, f, temp_path)
+                    raise
+
+        await asyncio.to_thread(self.save_image, f, temp_path, image_path)
+
+    def save_image(self, f, temp_path: Path, image_path: Path):
+        """Closes the finished temporary image file and moves it into place."""
+        f.close()
+        os.replace(temp_path, image_path)
+
+    def discard_image(self, f, temp_path: Path):
+        """Closes and deletes the temporary file of an incomplete image."""
+        f.close()
+        temp_path.unlink(missing_ok=True)
 
     def api_url(
         self,
@@ -148,16 +254,38 @@ class Scraper:
 
 async def main():
     """Runs the scraper."""
+    # Let gathered tasks (like image downloads) start running immediately until
+    # they first suspend, instead of always being scheduled on the event loop
+    # first. This is only available on Python 3.12+.
+    if hasattr(asyncio, "eager_task_factory"):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+
     db = DatabaseClient("src/client/static", "server-store")
 
-    async with aiohttp.ClientSession(
-        # connector=connector,
-    ) as session:
+    # The scraper makes thousands of requests to only a few hosts, so
+    # allow many more concurrent connections than aiohttp's default
+    # (100), and cache DNS lookups for the duration of the scrape.
+    # Idle connections are kept alive for longer than the default (15s)
+    # so that pauses between batches don't cost new TLS handshakes.
+    connector = aiohttp.TCPConnector(
+        limit=512,
+        limit_per_host=64,
+        ttl_dns_cache=600,
+        keepalive_timeout=60,
+    )
+
+    async with aiohttp.ClientSession(connector=connector) as session:
         scraper = Scraper(db, session)
         await scraper.init_product_categories()
         await scraper.scrape()
+        # Show the final count, which the throttling might have skipped
+        scraper.print_progress(force=True)
+        print()
 
     db._search.flush_default_index_queue()
 
 
+if uvloop is not None:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 asyncio.run(main())
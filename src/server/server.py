@@ -5,23 +5,241 @@ with the application running on the client.
 Authored by Evan. 
 """
 
+import asyncio
 from aiohttp import web
-from datetime import datetime
-from typing import Optional
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Any, Callable, Iterator, Mapping, Optional, TypeVar
+from urllib.parse import parse_qsl
+from modules.caching import LRUCache
 from modules.database import DatabaseClient
 from modules.rendering import Renderer
 from modules.sharing import WebSocketManager
 from modules import barcodes
 
+try:
+    # uvloop is a much faster drop-in replacement for asyncio's event loop
+    import uvloop
+except ImportError:
+    # uvloop isn't available on Windows
+    uvloop = None
+
 
 #### HELPER FUNCTIONS ####
 
+# Handlers build page models on other threads (with build_page_model()), so that the
+# many database requests they make don't hold up other requests or WebSocket updates.
+# Database writes stay on the event loop, so that handlers that read data and then
+# write it back (like leaving a kitchen) can't interleave with each other.
+
+# Pages listing more products than this are streamed to the client
+STREAM_THRESHOLD = 200
+# Size (in characters) of the pieces that streamed pages are sent in
+STREAM_CHUNK_SIZE = 16 * 1024
+
+# The auth failure messages never change, so they're only encoded once
+LOGIN_FAILED_BODY = Renderer.LOGIN_FAILED_PARTIAL.encode()
+SIGNUP_FAILED_BODY = Renderer.SIGNUP_FAILED_PARTIAL.encode()
+
+# Maximum number of HTML partials kept by `render_kitchen_partial()`
+PARTIAL_CACHE_SIZE = 256
+# LRU cache mapping (render function, kitchen ID, kitchen version, ...extra keys)
+# to the HTML partial that was rendered for that version of the kitchen
+partial_cache = LRUCache(PARTIAL_CACHE_SIZE)
+
+PageModel = TypeVar("PageModel")
+
+# Maps (page model builder, write count, ...arguments) to
+# the page models that `build_page_model()` is building
+in_flight_page_models: dict[tuple, asyncio.Future] = {}
+
+# HTML responses smaller than this many bytes aren't worth compressing
+COMPRESSION_THRESHOLD = 1024
+
+# Lets browsers reuse static assets for a day without asking the server again
+STATIC_CACHE_CONTROL = "public, max-age=86400"
+# Lets browsers reuse product images for a day without asking the server again
+PRODUCT_IMAGE_CACHE_CONTROL = "private, max-age=86400"
+# Maps the file extensions of static assets to their content types
+STATIC_CONTENT_TYPES = {
+    "css": "text/css",
+    "js": "text/javascript",
+    "svg": "image/svg+xml",
+}
 
-def html_response(body: str):
+
+def html_response(body: str | bytes):
     """Returns a `web.Response` with the `text/html` content type."""
+    # Encode the HTML up front, so that its size is
+    # known when deciding whether to compress it
+    if isinstance(body, str):
+        body = body.encode()
+
     return web.Response(body=body, content_type="text/html")
 
 
+async def stream_html_response(
+    request: web.Request,
+    chunks: Iterator[str],
+) -> web.StreamResponse:
+    """
+    Sends the HTML to the client while it's still being rendered, instead
+    of building the whole response body in memory first. Small chunks are
+    buffered up to `STREAM_CHUNK_SIZE` characters before being written,
+    so that each piece only has to be encoded once.
+    """
+    res = web.StreamResponse()
+    res.content_type = "text/html"
+    # Streamed pages are large, so always compress them (if the client supports it)
+    res.enable_compression()
+    await res.prepare(request)
+
+    buffer: list[str] = []
+    buffer_size = 0
+
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffer_size += len(chunk)
+
+        # Encode and write the buffer out once it's big enough
+        if buffer_size >= STREAM_CHUNK_SIZE:
+            await res.write("".join(buffer).encode())
+            buffer = []
+            buffer_size = 0
+
+    # Write whatever's left over
+    if buffer:
+        await res.write("".join(buffer).encode())
+
+    await res.write_eof()
+    return res
+
+
+def count_grouped_products(products: tuple[tuple[str, tuple], ...]) -> int:
+    """
+    Returns the number of products in a page model's
+    product listing that's grouped by category.
+    """
+    return sum(len(category_products) for _, category_products in products)
+
+
+def render_kitchen_partial(
+    render_partial: Callable[[PageModel], str],
+    build_page_data: Callable[[], PageModel],
+    kitchen_id: str,
+    *key,
+) -> str:
+    """
+    Returns `render_partial(build_page_data())`, reusing the HTML from the last
+    time it was called for the same version of the kitchen. Every session viewing
+    a kitchen is re-rendered when it's updated, so this means that only the first
+    session needs the page data to be fetched and rendered. `key` distinguishes
+    partials that depend on more than the kitchen (like a product's ID).
+
+    The partial mustn't depend on the user, and `build_page_data()` mustn't
+    depend on the search index (see `KitchenPartial`).
+    """
+    # The version is read before the page data, so the cached HTML
+    # is never older than the version that it's cached under
+    cache_key = (render_partial, kitchen_id, db.get_kitchen_version(kitchen_id), *key)
+    html = partial_cache.get(cache_key)
+
+    if html is None:
+        html = render_partial(build_page_data())
+        partial_cache.set(cache_key, html)
+
+    return html
+
+
+@dataclass(frozen=True, slots=True)
+class KitchenPartial:
+    """
+    Renders an HTML partial of a kitchen page for WebSocket updates. Partials
+    compare equal when they render the same part of the same kitchen (when
+    `render_partial`, `kitchen_id` and `key` match), so when an update is
+    published, each distinct partial is only rendered once for all the sessions
+    viewing it. Like with `render_kitchen_partial()`, the partial mustn't depend
+    on the user.
+
+    Unless `cache=False`, the HTML is also reused across updates with
+    `render_kitchen_partial()`. Partials built from search results (like the
+    product lists) must pass `cache=False`. Meilisearch indexes documents
+    asynchronously, so a list rendered from a search that ran before a write
+    was indexed would otherwise be cached under the kitchen's new version.
+    """
+
+    render_partial: Callable[[Any], str]
+    kitchen_id: str
+    key: tuple
+    build_page_data: Callable[[], Any] = field(compare=False)
+    cache: bool = field(default=True, compare=False)
+
+    def __call__(self) -> str:
+        if self.cache:
+            return render_kitchen_partial(
+                self.render_partial, self.build_page_data, self.kitchen_id, *self.key
+            )
+
+        return self.render_partial(self.build_page_data())
+
+
+async def build_page_model(
+    build_page_data: Callable[..., PageModel], *args
+) -> PageModel:
+    """
+    Returns `build_page_data(*args)`, which is run on another thread. Concurrent
+    calls with the same arguments share a single call, so a burst of identical
+    requests (like everyone in a kitchen reloading its page) only reads the data
+    once. Calls made after a kitchen is written to never share a call that was
+    started before, so they always see the write.
+    """
+    key = (build_page_data, db.get_write_count(), *args)
+    build = in_flight_page_models.get(key)
+
+    if build is None:
+        build = in_flight_page_models[key] = asyncio.ensure_future(
+            asyncio.to_thread(build_page_data, *args)
+        )
+        build.add_done_callback(lambda _: in_flight_page_models.pop(key, None))
+
+    # Shield the build, so that one of its requests being
+    # cancelled doesn't cancel it for the other requests
+    return await asyncio.shield(build)
+
+
+def parse_int(value) -> int:
+    """
+    Returns the integer in a query parameter or form field,
+    raising `HTTPBadRequest` if the value isn't an integer.
+    """
+    # Form fields can also be file uploads, which aren't integers
+    if not isinstance(value, str):
+        raise web.HTTPBadRequest()
+
+    try:
+        return int(value)
+    except ValueError:
+        raise web.HTTPBadRequest()
+
+
+async def read_form(request: web.Request) -> Mapping[str, Any]:
+    """
+    Returns the fields of the form submitted in the request body. URL-encoded
+    forms (which is how HTMX submits them) are parsed straight from the body's
+    text, skipping the multidict that `request.post()` builds. Like with
+    `request.post()`, only the first value of a repeated field is kept.
+    """
+    # Fall back to aiohttp for anything else, like forms with file uploads
+    if request.content_type != "application/x-www-form-urlencoded":
+        return await request.post()
+
+    fields: dict[str, str] = {}
+    for name, value in parse_qsl(await request.text(), keep_blank_values=True):
+        fields.setdefault(name, value)
+
+    return fields
+
+
 def htmx_redirect_response(url: str):
     """
     Returns a `web.Response` that instructs
@@ -35,11 +253,78 @@ def extract_client_email(request: web.Request) -> Optional[str]:
     Returns the email address of the user who submitted the request,
     or `None` if the request's session token is missing or invalid.
     """
-    if "auth_token" in request.cookies:
-        return db.get_auth_token_owner(request.cookies["auth_token"])
+    auth_token = request.cookies.get("auth_token")
+
+    if auth_token is not None:
+        return db.get_auth_token_owner(auth_token)
     return None
 
 
+def authorize(request: web.Request, login_redirect=False) -> tuple[str, str, bool]:
+    """
+    Checks that the request was made by a user with access to the kitchen in
+    the URL. Returns the user's email address, the kitchen's ID, and whether
+    the user is the kitchen's admin. Raises `HTTPUnauthorized` if the user
+    isn't logged in (or redirects them to the login page if `login_redirect`
+    is `True`), and raises `HTTPForbidden` if they can't access the kitchen.
+    """
+    kitchen_id = request.match_info["kitchen_id"]
+    email, has_access, is_admin = db.resolve_session(
+        request.cookies.get("auth_token"), kitchen_id
+    )
+
+    if email is None:
+        if login_redirect:
+            raise web.HTTPFound("/login")
+
+        raise web.HTTPUnauthorized()
+
+    if not has_access:
+        raise web.HTTPForbidden()
+
+    return email, kitchen_id, is_admin
+
+
+@web.middleware
+async def kitchen_auth_middleware(request: web.Request, handler):
+    """
+    Authorizes every request to a route under `/kitchens/{kitchen_id}/` with
+    `authorize()` before it's handled. The user's email address, the kitchen's
+    ID, and whether the user is the kitchen's admin are stored in
+    `request["email"]`, `request["kitchen_id"]` and `request["is_admin"]`.
+    Logged out users are redirected to the login page from GET requests.
+    """
+    if "kitchen_id" in request.match_info:
+        email, kitchen_id, is_admin = authorize(
+            request, login_redirect=request.method == "GET"
+        )
+        request["email"] = email
+        request["kitchen_id"] = kitchen_id
+        request["is_admin"] = is_admin
+
+    return await handler(request)
+
+
+@web.middleware
+async def compression_middleware(request: web.Request, handler):
+    """
+    Compresses HTML responses of at least `COMPRESSION_THRESHOLD` bytes with
+    whichever encoding the client accepts. HTMX partials are small but very
+    repetitive, so they usually shrink to a fraction of their size.
+    """
+    res = await handler(request)
+
+    if (
+        isinstance(res, web.Response)
+        and res.content_type == "text/html"
+        and isinstance(res.body, bytes)
+        and len(res.body) >= COMPRESSION_THRESHOLD
+    ):
+        res.enable_compression()
+
+    return res
+
+
 def get_usable_session_token(request: web.Request) -> tuple[str, bool]:
     """
     Gets the session token from the request if it has one, and creates
@@ -48,8 +333,10 @@ def get_usable_session_token(request: web.Request) -> tuple[str, bool]:
     indicates whether the session token was taken from the request.
     """
     # Return the session token from the request headers if it's there
-    if "X-Session-Token" in request.headers:
-        return request.headers["X-Session-Token"], True
+    session_token = request.headers.get("X-Session-Token")
+
+    if session_token is not None:
+        return session_token, True
 
     # Generate a new session token otherwise
     return db.gen_session_token(), False
@@ -83,7 +370,7 @@ async def signup_page(request: web.Request):
 async def login(request: web.Request):
     """Logs a user into their account."""
     # Extract user data from the request body
-    body = await request.post()
+    body = await read_form(request)
     email = body["email"]
     password = body["password"]
 
@@ -91,9 +378,10 @@ async def login(request: web.Request):
     assert isinstance(email, str)
     assert isinstance(password, str)
 
-    if not db.login_is_valid(email, password):
+    # Verifying the password hash is deliberately slow, so do it on another thread
+    if not await asyncio.to_thread(db.login_is_valid, email, password):
         # Display an error message if the login credential's are invalid
-        return html_response(body=renderer.login_failed_partial())
+        return html_response(body=LOGIN_FAILED_BODY)
 
     # Redirect the user to the kitchen list page
     res = htmx_redirect_response("/kitchens")
@@ -108,7 +396,7 @@ async def login(request: web.Request):
 async def signup(request: web.Request):
     """Creates a user account."""
     # Extract user data from the request body
-    body = await request.post()
+    body = await read_form(request)
     email = body["email"]
     username = body["username"]
     password = body["password"]
@@ -121,7 +409,7 @@ async def signup(request: web.Request):
     if not db.create_user(username, email, password):
         # Display an error message if an account
         # with the supplied email already exists
-        return html_response(body=renderer.signup_failed_partial())
+        return html_response(body=SIGNUP_FAILED_BODY)
 
     # Redirect the user to the kitchen list page
     res = htmx_redirect_response("/kitchens")
@@ -164,7 +452,7 @@ async def kitchens_page(request: web.Request):
 
     # Render and return the HTML response
     session_token, request_had_session = get_usable_session_token(request)
-    page_data = db.kitchens_page_model(email)
+    page_data = await build_page_model(db.kitchens_page_model, email)
     return html_response(
         renderer.kitchens_page(
             page_data,
@@ -183,7 +471,7 @@ async def create_kitchen(request: web.Request):
         raise web.HTTPUnauthorized()
 
     # Extract the kitchen name from the request body
-    body = await request.post()
+    body = await read_form(request)
     kitchen_name = body["name"]
 
     # To make the type checker happy...
@@ -195,19 +483,12 @@ async def create_kitchen(request: web.Request):
 
 
 async def kitchen_share(request: web.Request):
-    body = await request.post()
-    email_owner = extract_client_email(request)
+    email_owner = request["email"]
+    kitchen_id = request["kitchen_id"]
+    body = await read_form(request)
     email_other_user = body["email"]
-    kitchen_id = request.match_info["kitchen_id"]
-
-    if email_owner is None:
-        raise web.HTTPUnauthorized()
 
     assert isinstance(email_other_user, str)
-    access = db.user_has_access_to_kitchen(email_owner, kitchen_id)
-
-    if not access:
-        raise web.HTTPForbidden()
 
     share_kitchen = db.share_kitchen(kitchen_id, email_other_user)
     page_data = db.admin_settings_page_model(email_owner, kitchen_id)
@@ -219,29 +500,13 @@ async def kitchen_share(request: web.Request):
 
 
 async def kitchen_leave(request: web.Request):
-    email = extract_client_email(request)
-    if email is None:
-        raise web.HTTPUnauthorized()
-
-    kitchen_id = request.match_info["kitchen_id"]
-    db.leave_kitchen(email, kitchen_id)
+    db.leave_kitchen(request["email"], request["kitchen_id"])
     return htmx_redirect_response("/kitchens")
 
 
 async def kitchen_index(request: web.Request):
     """Redirects the user to the kitchen's inventory page."""
-    # Extract the kitchen ID from the URL
-    email = extract_client_email(request)
-
-    if email is None:
-        raise web.HTTPUnauthorized()
-
-    kitchen_id = request.match_info["kitchen_id"]
-
-    access = db.user_has_access_to_kitchen(email, kitchen_id)
-
-    if not access:
-        raise web.HTTPForbidden()
+    kitchen_id = request["kitchen_id"]
 
     # Redirect any /kitchens/{kitchen_id} request to /kitchens/{kitchen_id}/inventory
     raise web.HTTPFound(f"/kitchens/{kitchen_id}/inventory")
@@ -249,23 +514,11 @@ async def kitchen_index(request: web.Request):
 
 async def kitchen_settings(request: web.Request):
     """Responds with the HTML of the kitchen settings page."""
-    email = extract_client_email(request)
-
-    if email is None:
-        # Redirect the user to the login page if they're not already logged in
-        raise web.HTTPFound("/login")
-
-    # Extract kitchen ID from URL
-    kitchen_id = request.match_info["kitchen_id"]
-
-    access = db.user_has_access_to_kitchen(email, kitchen_id)
-
-    if not access:
-        raise web.HTTPForbidden()
-
+    email = request["email"]
+    kitchen_id = request["kitchen_id"]
     # Check if the user is an admin, because kitchen admins and
     # non-admins have different content on their kitchen settings page
-    user_is_admin = db.user_owns_kitchen(email, kitchen_id)
+    user_is_admin = request["is_admin"]
 
     session_token, request_had_session = get_usable_session_token(request)
 
@@ -273,7 +526,9 @@ async def kitchen_settings(request: web.Request):
     # If so, give admin access.
     if user_is_admin:
         # Render the HTML for if the user is the kitchen admin
-        page_data = db.admin_settings_page_model(email, kitchen_id)
+        page_data = await build_page_model(
+            db.admin_settings_page_model, email, kitchen_id
+        )
         html = renderer.admin_settings_page(
             page_data,
             session_token,
@@ -281,7 +536,9 @@ async def kitchen_settings(request: web.Request):
         )
     else:
         # Render the HTML for if the user is not the kitchen admin
-        page_data = db.generic_kitchen_page_model(email, kitchen_id)
+        page_data = await build_page_model(
+            db.generic_kitchen_page_model, email, kitchen_id
+        )
         html = renderer.nonadmin_settings_page(
             page_data,
             session_token,
@@ -298,45 +555,55 @@ async def static_asset(request: web.Request):
 
     # Extract filepath id from ?
     filepath = request.match_info["filepath"]
-    file = db.get_static_asset(filepath, use_cache=False)
 
-    if file is None:
+    # Take filepath's content type (e.g. picture.jpg, will extract jpg).
+    # rpartition() only splits off the extension, without building a list.
+    file_ext = filepath.rpartition(".")[2]
+    content_type = STATIC_CONTENT_TYPES.get(file_ext)
+
+    # Files that we can't serve (like the gzipped copies
+    # of the assets) are treated as if they don't exist
+    if content_type is None:
         raise web.HTTPNotFound()
 
-    # Define content type
-    content_types = {
-        "css": "text/css",
-        "js": "text/javascript",
-        "svg": "image/svg+xml",
-    }
+    path = db.get_static_asset_path(filepath)
 
-    # Take filepath's content type (e.g. picture.jpg, will extract jpg)
-    file_ext = filepath.split(".")[-1]
-    return web.Response(body=file, content_type=content_types[file_ext])
+    if path is None:
+        raise web.HTTPNotFound()
 
+    # FileResponse sends the file straight from disk (with sendfile() where it can),
+    # and answers conditional requests for files that haven't changed with a 304.
+    # Clients that accept gzip are sent the copy compressed at startup instead, so
+    # caches need to keep the two versions apart by the Accept-Encoding header.
+    return web.FileResponse(
+        path,
+        headers={
+            "Content-Type": content_type,
+            "Cache-Control": STATIC_CACHE_CONTROL,
+            "Vary": "Accept-Encoding",
+        },
+    )
 
-async def product_image(request: web.Request):
-    email = extract_client_email(request)
 
-    if email is None:
-        # The user isn't signed in
-        raise web.HTTPUnauthorized()
-
-    kitchen_id = request.match_info["kitchen_id"]
+async def product_image(request: web.Request):
+    kitchen_id = request["kitchen_id"]
     product_id = request.match_info["product_id"]
-    product_img = db.get_product_image(kitchen_id, product_id)
-    access = db.user_has_access_to_kitchen(email, kitchen_id)
+    path = db.get_product_image_path(kitchen_id, product_id)
 
-    if not access:
-        # User has no access to kitchen
-        raise web.HTTPForbidden()
-
-    if product_img is None:
+    if path is None:
         # If image does not exist
         raise web.HTTPNotFound()
 
-    # Return the JPEG
-    return web.Response(body=product_img, content_type="image/jpeg")
+    # Return the JPEG. Product images never change, so the browser can keep them,
+    # and FileResponse answers its conditional requests with a 304 once they expire.
+    # They're private because they're only visible to the kitchen's members.
+    return web.FileResponse(
+        path,
+        headers={
+            "Content-Type": "image/jpeg",
+            "Cache-Control": PRODUCT_IMAGE_CACHE_CONTROL,
+        },
+    )
 
 
 #### GROCERY LIST ####
@@ -344,33 +611,21 @@ async def product_image(request: web.Request):
 
 async def grocery_page(request: web.Request):
     """Responds with the HTML for the grocery list page."""
-    email = extract_client_email(request)
-
-    # Extract the kitchen ID from the URL
-    kitchen_id = request.match_info["kitchen_id"]
-
-    # Redirect the user to the login page if they're not logged in
-    if email is None:
-        raise web.HTTPFound("/login")
-
-    # Check if the user is allowed to access this kitchen
-    if not db.user_has_access_to_kitchen(email, kitchen_id):
-        raise web.HTTPForbidden()
+    email = request["email"]
+    kitchen_id = request["kitchen_id"]
 
     # Get the data needed to render the page
-    page_data = db.grocery_page_model(email, kitchen_id)
+    page_data = await build_page_model(db.grocery_page_model, email, kitchen_id)
     session_token, request_had_session = get_usable_session_token(request)
 
-    def render_grocery_list_partial():
-        """Renders the HTML partial of the grocery list."""
-        # Get the updated page data
-        page_data = db.grocery_page_model(
-            email,
-            kitchen_id,
-        )
-
-        # Render the HTML
-        return renderer.grocery_partial(page_data)
+    # Renders the HTML partial of the grocery list
+    render_grocery_list_partial = KitchenPartial(
+        renderer.grocery_partial,
+        kitchen_id,
+        ("",),
+        lambda: db.grocery_page_model(email, kitchen_id),
+        cache=False,
+    )
 
     # Allow the user to receive WebSocket updates to this page
     ws_manager.subscribe(
@@ -381,6 +636,17 @@ async def grocery_page(request: web.Request):
         },
     )
 
+    # Stream the HTML response if the grocery list is large
+    if count_grouped_products(page_data.products) > STREAM_THRESHOLD:
+        return await stream_html_response(
+            request,
+            renderer.grocery_page_stream(
+                page_data,
+                session_token,
+                not request_had_session,
+            ),
+        )
+
     # Render and return the HTML response
     return html_response(
         renderer.grocery_page(
@@ -393,37 +659,30 @@ async def grocery_page(request: web.Request):
 
 async def search_grocery(request: web.Request):
     """Filters the grocery list based on a search query."""
-    email = extract_client_email(request)
+    email = request["email"]
+    kitchen_id = request["kitchen_id"]
 
     # Extract the search query from the request body
-    body = await request.post()
+    body = await read_form(request)
     search_query = body["query"]
 
-    # Extract the kitchen ID from the URL
-    kitchen_id = request.match_info["kitchen_id"]
-
-    # You can't search a grocery list if you're not logged in
-    if email is None:
-        raise web.HTTPUnauthorized()
-
     # To make the checker happy...
     assert isinstance(search_query, str)
 
     # Get the data required to render the page
-    page_data = db.grocery_page_model(email, kitchen_id, search_query)
+    page_data = await build_page_model(
+        db.grocery_page_model, email, kitchen_id, search_query
+    )
     session_token, _ = get_usable_session_token(request)
 
-    def render_grocery_list_partial():
-        """Renders the HTML partial of the grocery list."""
-        # Get the updated page data
-        page_data = db.grocery_page_model(
-            email,
-            kitchen_id,
-            search_query,
-        )
-
-        # Render the HTML
-        return renderer.grocery_partial(page_data)
+    # Renders the HTML partial of the grocery list, filtered by the search query
+    render_grocery_list_partial = KitchenPartial(
+        renderer.grocery_partial,
+        kitchen_id,
+        (search_query,),
+        lambda: db.grocery_page_model(email, kitchen_id, search_query),
+        cache=False,
+    )
 
     # Allow the user to receive WebSocket updates to this page
     ws_manager.subscribe(
@@ -440,21 +699,11 @@ async def search_grocery(request: web.Request):
 
 async def barcode_scanner_page(request: web.Request):
     """Returns the HTML for the barcode scanner page."""
-    email = extract_client_email(request)
-
-    # Redirect the user to the login page if they're not logged in
-    if email is None:
-        raise web.HTTPFound("/login")
-
-    # Extract the kitchen ID from the URL
-    kitchen_id = request.match_info["kitchen_id"]
-
-    # Check if the user is allowed to access this kitchen
-    if not db.user_has_access_to_kitchen(email, kitchen_id):
-        raise web.HTTPForbidden()
+    email = request["email"]
+    kitchen_id = request["kitchen_id"]
 
     # Get the data required to render the page
-    page_data = db.generic_kitchen_page_model(email, kitchen_id)
+    page_data = await build_page_model(db.generic_kitchen_page_model, email, kitchen_id)
     session_token, request_had_session = get_usable_session_token(request)
 
     def render_barcode_redirector(image: bytes) -> str:
@@ -497,31 +746,25 @@ async def barcode_scanner_page(request: web.Request):
 
 
 async def grocery_product_page(request: web.Request):
-    email = extract_client_email(request)
+    email = request["email"]
+    kitchen_id = request["kitchen_id"]
 
-    # Extract the kitchen and product IDs from the URL
-    kitchen_id = request.match_info["kitchen_id"]
+    # Extract the product ID from the URL
     product_id = request.match_info["product_id"]
 
-    # Redirect the user to the login page if they're not logged in
-    if email is None:
-        raise web.HTTPFound("/login")
-
     # Get the data required to render the response
     session_token, request_had_session = get_usable_session_token(request)
-    page_data = db.grocery_product_page_model(email, kitchen_id, product_id)
-
-    def render_grocery_amount_partial():
-        """Renders the HTML partial of the amount widget."""
-        # Get the updated page data
-        page_data = db.grocery_product_page_model(
-            email,
-            kitchen_id,
-            product_id,
-        )
+    page_data = await build_page_model(
+        db.grocery_product_page_model, email, kitchen_id, product_id
+    )
 
-        # Render the updated HTML
-        return renderer.grocery_product_amount_partial(page_data)
+    # Renders the HTML partial of the amount widget
+    render_grocery_amount_partial = KitchenPartial(
+        renderer.grocery_product_amount_partial,
+        kitchen_id,
+        (product_id,),
+        lambda: db.grocery_product_page_model(email, kitchen_id, product_id),
+    )
 
     # Allow the user to receive WebSocket updates to this page
     ws_manager.subscribe(
@@ -543,18 +786,13 @@ async def grocery_product_page(request: web.Request):
 
 async def set_product(request: web.Request):
     """Updates the amount of the grocery product."""
-    email = extract_client_email(request)
-
-    # You can't modify the grocery list if you're not logged in
-    if email is None:
-        raise web.HTTPUnauthorized()
+    kitchen_id = request["kitchen_id"]
 
-    # Extract the kitchen and product IDs from the URL
-    kitchen_id = request.match_info["kitchen_id"]
+    # Extract the product ID from the URL
     product_id = request.match_info["product_id"]
 
     # Get the updated amount of the product from the URL's query parameters
-    amount = int(request.query["amount"])
+    amount = parse_int(request.query["amount"])
 
     # Update the database with the new amount
     db.set_groc_product_count(kitchen_id, product_id, amount)
@@ -573,29 +811,28 @@ async def set_product(request: web.Request):
 
 
 async def buy_grocery_product(request: web.Request):
-    # Extract kitchen and product IDs from the URL
-    kitchen_id = request.match_info["kitchen_id"]
+    kitchen_id = request["kitchen_id"]
+
+    # Extract the product ID from the URL
     product_id = request.match_info["product_id"]
 
     # Extract the purchase data from the request body
-    body = await request.post()
-    amount = body["amount"]
-    # To make the checker happy...
-    assert isinstance(amount, str)
+    body = await read_form(request)
+    amount = parse_int(body["amount"])
 
     if "include_expiry" in body:
         # Extract expiry date from request body
-        exp_year, exp_month, exp_day = body["yyyy"], body["mm"], body["dd"]
-        assert isinstance(exp_year, str)
-        assert isinstance(exp_month, str)
-        assert isinstance(exp_day, str)
-        expiry = (int(exp_year), int(exp_month), int(exp_day))
+        expiry = (
+            parse_int(body["yyyy"]),
+            parse_int(body["mm"]),
+            parse_int(body["dd"]),
+        )
     else:
         # No expiry date was specified
         expiry = None
 
     # Move product from kitchen to inventory
-    db.buy_product(kitchen_id, product_id, expiry, int(amount))
+    db.buy_product(kitchen_id, product_id, expiry, amount)
 
     # Update the UI on every relevant client
     await ws_manager.publish_update(
@@ -619,18 +856,8 @@ async def buy_grocery_product(request: web.Request):
 
 
 async def inventory_page(request: web.Request):
-    email = extract_client_email(request)
-
-    # Redirect the user to the login page if they're not logged in
-    if email is None:
-        raise web.HTTPFound("/login")
-
-    # Extract kitchen ID from URL
-    kitchen_id = request.match_info["kitchen_id"]
-
-    # Check if the user is supposed to have access to this kitchen
-    if not db.user_has_access_to_kitchen(email, kitchen_id):
-        raise web.HTTPForbidden()
+    email = request["email"]
+    kitchen_id = request["kitchen_id"]
 
     session_token, request_had_session = get_usable_session_token(request)
 
@@ -638,12 +865,14 @@ async def inventory_page(request: web.Request):
     # if the URL has a "sort-by-category" parameter
     if "sort-by-category" in request.query:
 
-        def render_inventory_list_partial() -> str:
-            """Returns the updated HTML of the inventory list, sorted by category."""
-            # Get the data required to render the inventory list
-            page_data = db.inventory_page_model(email, kitchen_id)
-            # Render the inventory list
-            return renderer.inventory_partial(page_data)
+        # Renders the HTML of the inventory list, sorted by category
+        render_inventory_list_partial = KitchenPartial(
+            renderer.inventory_partial,
+            kitchen_id,
+            (),
+            lambda: db.inventory_page_model(email, kitchen_id),
+            cache=False,
+        )
 
         # Allow the user to receive WebSocket updates to this page
         ws_manager.subscribe(
@@ -655,7 +884,19 @@ async def inventory_page(request: web.Request):
         )
 
         # Render and return the response
-        page_data = db.inventory_page_model(email, kitchen_id)
+        page_data = await build_page_model(db.inventory_page_model, email, kitchen_id)
+
+        # Stream the response if the inventory list is large
+        if count_grouped_products(page_data.products) > STREAM_THRESHOLD:
+            return await stream_html_response(
+                request,
+                renderer.inventory_page_stream(
+                    page_data,
+                    session_token,
+                    not request_had_session,
+                ),
+            )
+
         return html_response(
             renderer.inventory_page(
                 page_data,
@@ -666,12 +907,14 @@ async def inventory_page(request: web.Request):
 
     # Sort the inventory list by expiry date
     # if the "sort-by-category" parameter isn't there
-    def render_sorted_inventory_list_partial() -> str:
-        """Returns the updated HTML of the inventory list, sorted by expiry date."""
-        # Get the data required to render the inventory list
-        page_data = db.sorted_inventory_page_model(email, kitchen_id)
-        # Render the inventory list
-        return renderer.sorted_inventory_partial(page_data)
+    # Renders the HTML of the inventory list, sorted by expiry date
+    render_sorted_inventory_list_partial = KitchenPartial(
+        renderer.sorted_inventory_partial,
+        kitchen_id,
+        (),
+        lambda: db.sorted_inventory_page_model(email, kitchen_id),
+        cache=False,
+    )
 
     # Allow the user to receive WebSocket updates to this page
     ws_manager.subscribe(
@@ -683,7 +926,21 @@ async def inventory_page(request: web.Request):
     )
 
     # Render and return the response
-    page_data = db.sorted_inventory_page_model(email, kitchen_id)
+    page_data = await build_page_model(
+        db.sorted_inventory_page_model, email, kitchen_id
+    )
+
+    # Stream the response if the inventory list is large
+    if len(page_data.products) > STREAM_THRESHOLD:
+        return await stream_html_response(
+            request,
+            renderer.sorted_inventory_page_stream(
+                page_data,
+                session_token,
+                not request_had_session,
+            ),
+        )
+
     return html_response(
         renderer.sorted_inventory_page(
             page_data,
@@ -695,36 +952,25 @@ async def inventory_page(request: web.Request):
 
 async def inventory_product_page(request: web.Request):
     """Responds with the HTML of an inventory product's page."""
-    email = extract_client_email(request)
-
-    # Redirect the user to the login page if they're not logged in
-    if email is None:
-        raise web.HTTPFound("/login")
+    email = request["email"]
+    kitchen_id = request["kitchen_id"]
 
-    # Extract the kitchen and product IDs from the URL
-    kitchen_id = request.match_info["kitchen_id"]
+    # Extract the product ID from the URL
     product_id = request.match_info["product_id"]
-    access = db.user_has_access_to_kitchen(email, kitchen_id)
-
-    # Check if the user has access to this kitchen
-    if not access:
-        raise web.HTTPForbidden()
 
     # Render the response
-    page_data = db.inventory_product_page_model(email, kitchen_id, product_id)
+    page_data = await build_page_model(
+        db.inventory_product_page_model, email, kitchen_id, product_id
+    )
     session_token, request_had_session = get_usable_session_token(request)
 
-    def render_inventory_product_partial():
-        """Renders the HTML partial of the amount selector."""
-        # Get the updated page data
-        page_data = db.inventory_product_page_model(
-            email,
-            kitchen_id,
-            product_id,
-        )
-
-        # Render the updated HTML
-        return renderer.inventory_product_partial(page_data)
+    # Renders the HTML partial of the amount selector
+    render_inventory_product_partial = KitchenPartial(
+        renderer.inventory_product_partial,
+        kitchen_id,
+        (product_id,),
+        lambda: db.inventory_product_page_model(email, kitchen_id, product_id),
+    )
 
     # Allow the user to receive WebSocket updates to this page
     ws_manager.subscribe(
@@ -746,64 +992,65 @@ async def inventory_product_page(request: web.Request):
 
 
 async def use_inventory_product(request: web.Request):
-    email = extract_client_email(request)
+    email = request["email"]
+    kitchen_id = request["kitchen_id"]
 
-    # Extract the kitchen and product IDs from the URL
-    kitchen_id = request.match_info["kitchen_id"]
+    # Extract the product ID from the URL
     product_id = request.match_info["product_id"]
 
-    # You can't remove inventory products if you're not logged in
-    if email is None:
-        raise web.HTTPUnauthorized()
-
-    # Get the data required to render the page
-    page_data = db.inventory_product_page_model(email, kitchen_id, product_id)
-
     # Return a confirmation dialogue asking the user if
     # they want to add the product to the grocery list
-    if "move-to-grocery" not in request.query:
+    move_to_grocery_param = request.query.get("move-to-grocery")
+
+    if move_to_grocery_param is None:
+        # Only the dialogue needs the page data, so it isn't
+        # fetched when the product is actually being used
+        page_data = await build_page_model(
+            db.inventory_product_page_model, email, kitchen_id, product_id
+        )
         return html_response(renderer.inventory_product_confirmation_partial(page_data))
 
-    body = await request.post()
+    body = await read_form(request)
     expiry_amounts = {}
 
     # Extract the expiry data from the request body
-    for expiry_str in body:
+    for expiry_str, amount_str in body.items():
         if expiry_str == "non_expirables":
             expiry = None
         else:
-            expiry = datetime.strptime(expiry_str, "%Y-%m-%d").date()
+            # fromisoformat() parses YYYY-MM-DD dates in C, which is
+            # much faster than strptime()'s format string parser
+            try:
+                expiry = date.fromisoformat(expiry_str)
+            except ValueError:
+                raise web.HTTPBadRequest()
 
-        amount_str = body[expiry_str]
-        assert isinstance(amount_str, str)
+        expiry_amounts[expiry] = parse_int(amount_str)
 
-        amount = int(amount_str)
-        expiry_amounts[expiry] = amount
-
-    move_to_grocery = request.query["move-to-grocery"] == "true"
+    move_to_grocery = move_to_grocery_param == "true"
 
     # Update the database
     db.use_product(kitchen_id, product_id, expiry_amounts, move_to_grocery)
 
     # Update the UI on every relevant client
-    await ws_manager.publish_update(
-        [
-            # Update the clients on the inventory page
-            f"{kitchen_id}.inventory",
-            # Update the clients on this product's inventory page
-            f"{kitchen_id}.inventory.{product_id}",
-        ]
-    )
+    topics = [
+        # Update the clients on the inventory page
+        f"{kitchen_id}.inventory",
+        # Update the clients on this product's inventory page
+        f"{kitchen_id}.inventory.{product_id}",
+    ]
 
     if move_to_grocery:
-        await ws_manager.publish_update(
-            [
-                # Update the clients on the grocery page
-                f"{kitchen_id}.grocery",
-                # Update the clients on this product's grocery page
-                f"{kitchen_id}.grocery.{product_id}",
-            ]
-        )
+        topics += [
+            # Update the clients on the grocery page
+            f"{kitchen_id}.grocery",
+            # Update the clients on this product's grocery page
+            f"{kitchen_id}.grocery.{product_id}",
+        ]
+
+    # Publish all the updates at once, so that sessions subscribed to
+    # several of the topics are re-rendered and sent a single message
+    await ws_manager.publish_update(topics)
 
     return htmx_redirect_response(f"/kitchens/{kitchen_id}/inventory")
 
@@ -829,11 +1076,23 @@ async def websocket(request: web.Request):
     return ws
 
 
+async def close_database(app: web.Application):
+    """Closes the database's connections when the server shuts down."""
+    db.close()
+
+
 db = DatabaseClient("src/client/static", "server-store")
-renderer = Renderer("src/client/templates")
+# Compress the static assets once up front, instead of on every request for them
+db.compress_static_assets()
+renderer = Renderer(
+    "src/client/templates",
+    "server-store/jinja-cache",
+    "server-store/compiled-templates",
+)
 ws_manager = WebSocketManager()
 
-app = web.Application()
+# Every route under /kitchens/{kitchen_id}/ is authorized by the middleware
+app = web.Application(middlewares=[compression_middleware, kitchen_auth_middleware])
 app.add_routes(
     [
         #### REDIRECTS ####
@@ -879,5 +1138,12 @@ app.add_routes(
         ),
     ]
 )
+app.on_cleanup.append(close_database)
+
+
+def run():
+    """Runs the web server until it's interrupted."""
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-web.run_app(app)
+    web.run_app(app)
@@ -0,0 +1,91 @@
+"""
+Tests that the `{% cache %}` blocks of the product list partials are keyed on
+the kitchen's version and the products on the page, so that a cached list is
+never served for a different search or an older version of the kitchen.
+"""
+
+import re
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("jinja2")
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT / "src/server"))
+
+from modules.models import (
+    GroceryPage,
+    GroceryProduct,
+    InventoryPage,
+    InventoryProduct,
+    Kitchen,
+    User,
+)
+from modules.rendering import Renderer
+
+USER = User("user@example.com", "user")
+
+
+@pytest.fixture
+def renderer():
+    return Renderer(str(PROJECT_ROOT / "src/client/templates"))
+
+
+def grocery_page(version: int, *products: GroceryProduct) -> GroceryPage:
+    """Returns the page model of kitchen "k1"'s grocery list."""
+    return GroceryPage(
+        USER,
+        Kitchen("Kitchen", "k1", version),
+        (("Fruit", products),),
+        frozenset(p.id for p in products),
+    )
+
+
+def amounts(html: str) -> list[str]:
+    """Returns the product amounts displayed in a rendered grocery list."""
+    return re.findall(r">\s*(\d+)\s*<", html)
+
+
+APPLE = GroceryProduct("Apple", "Fruit", "p1", 2)
+BANANA = GroceryProduct("Banana", "Fruit", "p2", 3)
+MORE_APPLES = GroceryProduct("Apple", "Fruit", "p1", 5)
+
+
+def test_same_version_and_products_reuses_the_list(renderer):
+    renderer.grocery_partial(grocery_page(1, APPLE))
+    # The version wasn't bumped, so the list cached for it is used
+    html = renderer.grocery_partial(grocery_page(1, MORE_APPLES))
+
+    assert amounts(html) == ["2"]
+
+
+def test_different_searches_at_the_same_version_render_their_own_lists(renderer):
+    apple_html = renderer.grocery_partial(grocery_page(1, APPLE))
+    banana_html = renderer.grocery_partial(grocery_page(1, BANANA))
+
+    assert "Apple" in apple_html and "Banana" not in apple_html
+    assert "Banana" in banana_html and "Apple" not in banana_html
+
+
+def test_same_search_after_a_version_bump_is_re_rendered(renderer):
+    renderer.grocery_partial(grocery_page(1, APPLE))
+    html = renderer.grocery_partial(grocery_page(2, MORE_APPLES))
+
+    assert amounts(html) == ["5"]
+
+
+def test_lists_with_the_same_keys_in_different_templates_are_separate(renderer):
+    renderer.grocery_partial(grocery_page(1, APPLE))
+    html = renderer.inventory_partial(
+        InventoryPage(
+            USER,
+            Kitchen("Kitchen", "k1", 1),
+            (("Fruit", (InventoryProduct("Apple", "Fruit", "p1", 2, {}, 2),)),),
+            frozenset({"p1"}),
+        )
+    )
+
+    # The inventory list links to inventory product pages, not grocery ones
+    assert 'href="inventory/p1"' in html
@@ -0,0 +1,108 @@
+"""
+Tests that every route under `/kitchens/{kitchen_id}/` is authorized
+by the kitchen auth middleware before its handler runs.
+
+These need the Python dependencies and a running Redis Stack server
+(see the README), and are skipped otherwise.
+"""
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+redis = pytest.importorskip("redis")
+pytest.importorskip("meilisearch")
+pytest.importorskip("argon2")
+
+try:
+    redis.Redis().ping()
+except redis.exceptions.ConnectionError:
+    pytest.skip("Redis isn't running", allow_module_level=True)
+
+from aiohttp.test_utils import TestClient, TestServer
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+
+# Maps the auth tokens used by the tests to what `resolve_session()` returns for
+# them in kitchen "k1": (email, has access to the kitchen, is the kitchen's admin)
+SESSIONS = {
+    "outsider-token": ("outsider@example.com", False, False),
+}
+
+# (name, method, path, auth token) of the requests made by the tests
+REQUESTS = [
+    ("kitchen_index logged out", "GET", "/kitchens/k1", None),
+    ("product_image logged out", "GET", "/kitchens/k1/images/p1", None),
+    ("grocery_page outsider", "GET", "/kitchens/k1/grocery", "outsider-token"),
+    ("buy logged out", "POST", "/kitchens/k1/grocery/p1/buy", None),
+    ("buy outsider", "POST", "/kitchens/k1/grocery/p1/buy", "outsider-token"),
+    ("set outsider", "POST", "/kitchens/k1/grocery/p1/set", "outsider-token"),
+    ("leave outsider", "POST", "/kitchens/k1/settings/leave", "outsider-token"),
+]
+
+
+def fake_resolve_session(auth_token, kitchen_id):
+    """Stands in for `DatabaseClient.resolve_session()`."""
+    if kitchen_id != "k1" or auth_token not in SESSIONS:
+        return None, False, False
+
+    return SESSIONS[auth_token]
+
+
+@pytest.fixture(scope="module")
+def responses():
+    """
+    Makes every request in `REQUESTS` to the web server, and returns a dict
+    mapping their names to their (status code, Location header) pairs.
+    """
+    # The server's paths are relative to the project root
+    cwd = os.getcwd()
+    os.chdir(PROJECT_ROOT)
+    sys.path.insert(0, str(PROJECT_ROOT / "src/server"))
+
+    try:
+        import server
+
+        # Nothing is written to the database, so no accounts are needed,
+        # and the database client is left open when the test server stops
+        server.db.resolve_session = fake_resolve_session
+        server.db.close = lambda: None
+
+        async def send_requests():
+            results = {}
+
+            async with TestClient(TestServer(server.app)) as client:
+                for name, method, path, auth_token in REQUESTS:
+                    cookies = {"auth_token": auth_token} if auth_token else None
+                    res = await client.request(
+                        method, path, cookies=cookies, allow_redirects=False
+                    )
+                    results[name] = (res.status, res.headers.get("Location"))
+
+            return results
+
+        return asyncio.run(send_requests())
+    finally:
+        os.chdir(cwd)
+
+
+def test_logged_out_gets_are_redirected_to_login(responses):
+    # These used to respond with a 401
+    assert responses["kitchen_index logged out"] == (302, "/login")
+    assert responses["product_image logged out"] == (302, "/login")
+
+
+def test_logged_out_posts_are_unauthorized(responses):
+    # buy_grocery_product used to have no authentication at all
+    assert responses["buy logged out"][0] == 401
+
+
+def test_non_members_are_forbidden(responses):
+    assert responses["grocery_page outsider"][0] == 403
+    # These used to only check that the user was logged in
+    assert responses["buy outsider"][0] == 403
+    assert responses["set outsider"][0] == 403
+    assert responses["leave outsider"][0] == 403
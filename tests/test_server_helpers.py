@@ -0,0 +1,156 @@
+"""
+Tests the helper functions that the web server's handlers share.
+
+These need the Python dependencies and a running Redis Stack server
+(see the README), and are skipped otherwise.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+redis = pytest.importorskip("redis")
+pytest.importorskip("meilisearch")
+pytest.importorskip("argon2")
+
+try:
+    redis.Redis().ping()
+except redis.exceptions.ConnectionError:
+    pytest.skip("Redis isn't running", allow_module_level=True)
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+
+
+@pytest.fixture(scope="module")
+def server():
+    """Imports the web server module."""
+    # The server's paths are relative to the project root
+    cwd = os.getcwd()
+    os.chdir(PROJECT_ROOT)
+    sys.path.insert(0, str(PROJECT_ROOT / "src/server"))
+
+    try:
+        import server
+
+        return server
+    finally:
+        os.chdir(cwd)
+
+
+def test_builds_started_before_a_write_are_not_shared_after_it(server, monkeypatch):
+    write_count = 0
+    monkeypatch.setattr(server.db, "get_write_count", lambda: write_count)
+
+    started = threading.Event()
+    release = threading.Event()
+    build_count = 0
+
+    def build_page_data(kitchen_id: str) -> object:
+        nonlocal build_count
+        build_count += 1
+        started.set()
+        release.wait()
+        return object()
+
+    async def run():
+        nonlocal write_count
+        before = asyncio.ensure_future(server.build_page_model(build_page_data, "k1"))
+        await asyncio.sleep(0)
+        # Made while the first build is running and before any write
+        shared = asyncio.ensure_future(server.build_page_model(build_page_data, "k1"))
+        await asyncio.to_thread(started.wait)
+
+        write_count += 1
+        after = asyncio.ensure_future(server.build_page_model(build_page_data, "k1"))
+        await asyncio.sleep(0)
+
+        release.set()
+        return await before, await shared, await after
+
+    before, shared, after = asyncio.run(run())
+    assert before is shared
+    assert after is not before
+    assert build_count == 2
+
+
+@pytest.fixture(scope="module")
+def post(server):
+    """
+    Returns a function that posts a form to a test app, which responds with
+    the form's "a" and "b" fields as read by `read_form()`. `content_type`
+    is "urlencoded" or "multipart" (which `read_form()` hands to aiohttp).
+    """
+    from aiohttp import FormData, web
+    from aiohttp.test_utils import TestClient, TestServer
+
+    async def read_fields(request: web.Request):
+        fields = await server.read_form(request)
+        return web.json_response({name: fields.get(name) for name in ("a", "b")})
+
+    def post(fields: list[tuple[str, str]], content_type="urlencoded"):
+        form = FormData(fields)
+        if content_type == "multipart":
+            # Adding a file makes aiohttp encode the form as multipart
+            form.add_field("file", b"", filename="file.txt")
+
+        async def send():
+            # Apps can't be reused across event loops, so each post gets its own
+            app = web.Application()
+            app.router.add_post("/", read_fields)
+
+            async with TestClient(TestServer(app)) as client:
+                res = await client.post("/", data=form)
+                return await res.json()
+
+        return asyncio.run(send())
+
+    return post
+
+
+def test_read_form_keeps_the_first_value_of_repeated_fields(post):
+    assert post([("a", "1"), ("a", "2"), ("b", "3")]) == {"a": "1", "b": "3"}
+
+
+def test_read_form_keeps_blank_values(post):
+    assert post([("a", ""), ("b", "3")]) == {"a": "", "b": "3"}
+
+
+def test_read_form_falls_back_to_aiohttp_for_other_content_types(post):
+    fields = [("a", "1"), ("a", "2"), ("b", "")]
+    assert post(fields, "multipart") == {"a": "1", "b": ""}
+
+
+def test_parse_int_parses_integers(server):
+    assert server.parse_int("12") == 12
+    assert server.parse_int("-3") == -3
+
+
+@pytest.mark.parametrize("value", ["", "1.5", "twelve", None])
+def test_parse_int_rejects_non_integers(server, value):
+    from aiohttp import web
+
+    with pytest.raises(web.HTTPBadRequest):
+        server.parse_int(value)
+
+
+def test_non_integer_query_parameters_respond_with_400(server):
+    from aiohttp import web
+    from aiohttp.test_utils import TestClient, TestServer
+
+    async def read_amount(request: web.Request):
+        return web.json_response(server.parse_int(request.query["amount"]))
+
+    async def send():
+        app = web.Application()
+        app.router.add_get("/", read_amount)
+
+        async with TestClient(TestServer(app)) as client:
+            ok = await client.get("/", params={"amount": "4"})
+            bad = await client.get("/", params={"amount": "four"})
+            return ok.status, await ok.json(), bad.status
+
+    assert asyncio.run(send()) == (200, 4, 400)
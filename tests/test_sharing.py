@@ -0,0 +1,160 @@
+"""
+Tests the bookkeeping of `WebSocketManager`: removing subscribers, batching
+published updates, and disconnecting sessions whose messages can't be sent.
+"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT / "src/server"))
+
+from modules import sharing
+from modules.sharing import WebSocketManager
+
+
+class FakeWebSocket:
+    """
+    Stands in for `web.WebSocketResponse`. It receives no messages,
+    and its `async for` loop ends once it's closed.
+    """
+
+    def __init__(self, block_sends=False, send_error=None):
+        self.sent: list[str] = []
+        self.close_count = 0
+        self._block_sends = block_sends
+        self._send_error = send_error
+        self._closed = asyncio.Event()
+
+    async def send_str(self, data: str):
+        if self._send_error is not None:
+            raise self._send_error
+
+        # Never finish sending, like a client that stopped reading
+        if self._block_sends:
+            await asyncio.Event().wait()
+
+        self.sent.append(data)
+
+    async def close(self):
+        self.close_count += 1
+        self._closed.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await self._closed.wait()
+        raise StopAsyncIteration
+
+
+def check_subscriber_indexes(manager: WebSocketManager):
+    """Asserts that every subscriber's index points at its place in its topic's list."""
+    indexes = {
+        (topic, session_token): i
+        for topic, subscribers in manager._topic_subscribers.items()
+        for i, (session_token, _) in enumerate(subscribers)
+    }
+    assert manager._subscriber_indexes == indexes
+
+
+def test_removing_a_middle_subscriber_keeps_indexes_consistent():
+    manager = WebSocketManager()
+    for session_token in ("a", "b", "c", "d"):
+        manager.subscribe(session_token, {"topic": lambda: ""})
+
+    # Resubscribing unsubscribes the session from its previous topics
+    manager.subscribe("b", {})
+
+    assert [s for s, _ in manager._topic_subscribers["topic"]] == ["a", "d", "c"]
+    check_subscriber_indexes(manager)
+
+    manager.subscribe("a", {})
+    manager.subscribe("c", {})
+
+    assert [s for s, _ in manager._topic_subscribers["topic"]] == ["d"]
+    check_subscriber_indexes(manager)
+
+
+def test_removing_the_last_subscriber_forgets_the_topic():
+    manager = WebSocketManager()
+    manager.subscribe("a", {"topic": lambda: ""})
+    manager.subscribe("a", {})
+
+    assert manager._topic_subscribers == {}
+    assert manager._subscriber_indexes == {}
+
+
+def test_updates_published_together_are_sent_in_one_message():
+    render_count = 0
+
+    def render():
+        nonlocal render_count
+        render_count += 1
+        return "<div id='list'></div>"
+
+    async def run():
+        manager = WebSocketManager()
+        ws = FakeWebSocket()
+        manager.subscribe("a", {"k1.inventory": render, "k1.grocery": render})
+        connection = asyncio.create_task(manager.handle_connection("a", ws))
+        await asyncio.sleep(0)
+
+        # Both topics fall within one publish window
+        await manager.publish_update(["k1.inventory"])
+        await manager.publish_update(["k1.grocery"])
+        await asyncio.sleep(sharing.PUBLISH_WINDOW * 5)
+
+        await ws.close()
+        await connection
+        return ws.sent
+
+    assert asyncio.run(run()) == ["<div id='list'></div>"]
+    assert render_count == 1
+
+
+def test_a_session_with_a_full_queue_is_closed_once(monkeypatch):
+    monkeypatch.setattr(sharing, "SEND_QUEUE_SIZE", 2)
+
+    async def run():
+        manager = WebSocketManager()
+        ws = FakeWebSocket(block_sends=True)
+        connection = asyncio.create_task(manager.handle_connection("a", ws))
+        await asyncio.sleep(0)
+
+        # One message is stuck being sent, two fill the queue,
+        # and the rest overflow it while the socket is closing
+        for i in range(6):
+            manager._queue_message("a", f"message {i}")
+            await asyncio.sleep(0)
+
+        await asyncio.wait_for(connection, 1)
+        return manager, ws
+
+    manager, ws = asyncio.run(run())
+    assert ws.close_count == 1
+    assert manager._send_queues == {}
+    assert manager._connections == {}
+
+
+def test_a_failed_send_closes_the_socket():
+    async def run():
+        manager = WebSocketManager()
+        ws = FakeWebSocket(send_error=RuntimeError("send failed"))
+        connection = asyncio.create_task(manager.handle_connection("a", ws))
+        await asyncio.sleep(0)
+
+        manager._queue_message("a", "message")
+
+        # The sender closes the socket, which ends the connection
+        await asyncio.wait_for(connection, 1)
+        return manager, ws
+
+    manager, ws = asyncio.run(run())
+    assert ws.close_count == 1
+    assert manager._send_queues == {}